@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""benchmarks for sqlalchemy timezone-aware datetime support
+
+Run directly:
+  python benchmark_tzaware_datetime.py [--rows 1000,10000,100000] [--only NAME,...]
+                                       [--output results.json]
+
+Each benchmark runs once per data size and reports a flat dict of metrics
+(seconds, rows/second, bytes).  With --output the results are written as
+JSON, together with the interpreter and library versions, so runs before
+and after an upgrade can be compared.
+"""
+__author__ = 'Andrew Ittner <aji@rhymingpanda.com>'
+__copyright__ = "Public Domain (CC0) <http://creativecommons.org/publicdomain/zero/1.0/>"
+
+# stdlib
+import os
+import sys
+import csv
+import json
+import cPickle
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+from itertools import islice
+import multiprocessing
+
+# sqlalchemy
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Integer, Unicode
+from sqlalchemy import create_engine, select, func
+from sqlalchemy.orm import mapper, create_session, clear_mappers, compile_mappers, composite
+from sqlalchemy.ext.declarative import declarative_base
+
+# 3rd-party
+import dateutil
+from dateutil import tz
+from dateutil.parser import parse as tz_parse
+
+# module to benchmark
+import tzaware_datetime
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+class InfoMatic(object):
+    """mapped class for ORM benchmarks"""
+    def __init__(self, info, tzawaredate):
+        self.info = info
+        self.tzawaredate = tzawaredate
+
+def timed(func, *args):
+    """return (seconds, result) for a single call"""
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def best(func, repeat=3):
+    """fastest of repeat calls, in seconds"""
+    return min(timed(func)[0] for n in range(repeat))
+
+def sample_composite_values(rows):
+    """(utcdt, tzname, offsetseconds) triples spread over the common offsets"""
+    start = datetime.datetime(2010, 1, 1)
+    return [(start + datetime.timedelta(minutes=n), None, (n % 27 - 12) * 3600)
+            for n in xrange(rows)]
+
+def sample_realdates(rows):
+    """aware datetimes spread over a few named zones"""
+    zones = [tz.gettz(name) for name in ('Europe/Rome', 'America/Toronto',
+                                         'Asia/Tokyo', 'UTC')]
+    start = datetime.datetime(2010, 1, 1)
+    return [(start + datetime.timedelta(minutes=n)).replace(tzinfo=zones[n % len(zones)])
+            for n in xrange(rows)]
+
+def prep_table(engine, **kwargs):
+    """create an infomatic table with one TZAwareDateTime column named tzawaredate"""
+    metadata = MetaData()
+    table_infomatic = Table('infomatic', metadata,
+                            Column('id', Integer, primary_key=True),
+                            Column('info', Unicode(255)))
+    tzaware_datetime.helper.append_columns(table_infomatic, 'tzawaredate', **kwargs)
+    metadata.create_all(engine)
+    return table_infomatic
+
+def bench_construction(rows):
+    """TZAwareDateTime(realdate=...) from aware datetimes"""
+    realdates = sample_realdates(rows)
+    seconds = best(lambda: [tzaware_datetime.TZAwareDateTime(realdate=d) for d in realdates])
+    return {'seconds': seconds, 'rows_per_second': rows / seconds}
+
+def bench_realdate(rows):
+    """.realdate reads: the first rebuilds the datetime, later reads are cached"""
+    values = sample_composite_values(rows)
+    instances = [tzaware_datetime.TZAwareDateTime(*v) for v in values]
+    first = timed(lambda: [i.realdate for i in instances])[0]
+    cached = best(lambda: [i.realdate for i in instances])
+    return {'first_read_seconds': first, 'cached_read_seconds': cached}
+
+def bench_composite_values(rows):
+    """__composite_values__ as called by the ORM at flush"""
+    instances = [tzaware_datetime.TZAwareDateTime(realdate=d) for d in sample_realdates(rows)]
+    return {'seconds': best(lambda: [i.__composite_values__() for i in instances])}
+
+def tzinfo_footprint(tzinfos):
+    """number of distinct tzinfo objects and their approximate size in bytes"""
+    distinct = dict((id(t), t) for t in tzinfos).values()
+    size = sum(sys.getsizeof(t) + sys.getsizeof(t.__dict__) for t in distinct)
+    return len(distinct), size
+
+def bench_tzinfo_registry(rows):
+    """read .realdate for rows values with and without the shared tzinfo registry"""
+    values = sample_composite_values(rows)
+    results = {}
+    for label, maxsize in (('registry', 1024), ('no_registry', 0)):
+        tzaware_datetime.tzinfo_registry = tzaware_datetime.TZInfoRegistry(maxsize=maxsize)
+        seconds, realdates = timed(lambda: [tzaware_datetime.TZAwareDateTime(*v).realdate
+                                            for v in values])
+        count, size = tzinfo_footprint([d.tzinfo for d in realdates])
+        results['%s.seconds' % label] = seconds
+        results['%s.tzinfo_objects' % label] = count
+        results['%s.tzinfo_bytes' % label] = size
+    tzaware_datetime.tzinfo_registry = tzaware_datetime.TZInfoRegistry()
+    return results
+
+def instance_footprint(value):
+    """bytes used by a value's own object and __dict__ (shared datetimes excluded)"""
+    size = sys.getsizeof(value)
+    if hasattr(value, '__dict__'):
+        size += sys.getsizeof(value.__dict__)
+    return size
+
+def bench_instance_memory(rows):
+    """per-instance memory and construction time of each TZAwareDateTime variant"""
+    values = sample_composite_values(rows)
+    results = {}
+    for composite_class in (tzaware_datetime.TZAwareDateTime,
+                            tzaware_datetime.SlottedTZAwareDateTime,
+                            tzaware_datetime.FrozenTZAwareDateTime):
+        seconds, instances = timed(lambda: [composite_class(*v) for v in values])
+        results['%s.seconds' % composite_class.__name__] = seconds
+        results['%s.bytes_per_instance' % composite_class.__name__] = \
+            instance_footprint(instances[0])
+    return results
+
+def bench_orm(rows):
+    """ORM flush, ordered and range queries through helper composites on SQLite"""
+    realdates = sample_realdates(rows)
+    low, high = realdates[rows // 4], realdates[rows // 2]
+    tempdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for label, url in (('memory', 'sqlite:///:memory:'),
+                           ('file', 'sqlite:///%s' % os.path.join(tempdir, 'orm.sqlite'))):
+            engine = create_engine(url)
+            table_infomatic = prep_table(engine, index=True)
+            mapper(InfoMatic, table_infomatic, properties={
+                'tzawaredate': tzaware_datetime.helper.get_mapper_definition(table_infomatic,
+                                                                             'tzawaredate')})
+            session = create_session(bind=engine)
+            def flush():
+                session.begin()
+                session.add_all([InfoMatic(u'x', tzaware_datetime.TZAwareDateTime(realdate=d))
+                                 for d in realdates])
+                session.commit()
+            results['%s.flush_seconds' % label] = timed(flush)[0]
+            session.expunge_all()
+            ordered = session.query(InfoMatic).order_by(InfoMatic.tzawaredate.desc()).limit(1000)
+            results['%s.ordered_seconds' % label] = best(lambda: ordered.all())
+            ranged = session.query(InfoMatic).filter(InfoMatic.tzawaredate.between(low, high))
+            results['%s.range_seconds' % label] = best(lambda: ranged.all())
+            session.close()
+            clear_mappers()
+            engine.dispose()
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+def bench_ingest(rows):
+    """rows/second inserting aware datetimes through the ORM and through bulk.insert"""
+    realdates = sample_realdates(rows)
+    results = {}
+
+    engine = create_engine('sqlite:///:memory:')
+    table_infomatic = prep_table(engine)
+    mapper(InfoMatic, table_infomatic, properties={
+        'tzawaredate': tzaware_datetime.helper.get_mapper_definition(table_infomatic,
+                                                                     'tzawaredate')})
+    session = create_session(bind=engine)
+    def orm_ingest():
+        session.begin()
+        session.add_all([InfoMatic(u'x', tzaware_datetime.TZAwareDateTime(realdate=d))
+                         for d in realdates])
+        session.commit()
+    results['orm.rows_per_second'] = rows / timed(orm_ingest)[0]
+    session.close()
+    clear_mappers()
+
+    engine = create_engine('sqlite:///:memory:')
+    table_infomatic = prep_table(engine)
+    def bulk_ingest():
+        connection = engine.connect()
+        transaction = connection.begin()
+        tzaware_datetime.bulk.insert(connection, table_infomatic, 'tzawaredate', realdates)
+        transaction.commit()
+        connection.close()
+    results['bulk.rows_per_second'] = rows / timed(bulk_ingest)[0]
+    return results
+
+def bench_arrays(rows):
+    """seconds to turn utcdate/tzoffset columns into UTC, offset and local values"""
+    values = sample_composite_values(rows)
+    utcdates = [v[0] for v in values]
+    offsets = [v[2] for v in values]
+    results = {}
+    results['row_by_row.seconds'] = timed(lambda: [tzaware_datetime.TZAwareDateTime(*v).realdate
+                                                   for v in values])[0]
+    results['python.seconds'] = best(lambda: tzaware_datetime.arrays.from_columns(
+        utcdates, offsets, use_numpy=False))
+    if tzaware_datetime.numpy is not None:
+        results['numpy.seconds'] = best(lambda: tzaware_datetime.arrays.from_columns(
+            utcdates, offsets))
+    return results
+
+def bench_storage_layouts(rows):
+    """file size and query time of each storage layout on file-backed SQLite"""
+    realdates = sample_realdates(rows)
+    low = realdates[rows // 4]
+    high = realdates[rows // 2]
+    tempdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for storage in ('datetime', 'epoch'):
+            path = os.path.join(tempdir, '%s.sqlite' % storage)
+            engine = create_engine('sqlite:///%s' % path)
+            table_infomatic = prep_table(engine, index=True, storage=storage)
+            connection = engine.connect()
+            transaction = connection.begin()
+            composite_class = tzaware_datetime._storage_layout(storage)[0]
+            keys = ['tzawaredate_%s' % c.key
+                    for c in tzaware_datetime._storage_layout(storage)[1]]
+            connection.execute(table_infomatic.insert(),
+                               [dict(zip(keys, composite_class(realdate=d).__composite_values__()))
+                                for d in realdates])
+            transaction.commit()
+            column_utc = table_infomatic.c[keys[0]]
+            query_range = select([func.count()], column_utc.between(
+                tzaware_datetime._utc_operand(low), tzaware_datetime._utc_operand(high)))
+            query_ordered = select([table_infomatic]).order_by(column_utc.desc()).limit(1000)
+            results['%s.range_count_seconds' % storage] = best(
+                lambda: connection.execute(query_range).scalar())
+            results['%s.ordered_seconds' % storage] = best(
+                lambda: connection.execute(query_ordered).fetchall())
+            connection.close()
+            engine.dispose()
+            results['%s.file_bytes' % storage] = os.path.getsize(path)
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+def bench_instrumentation(rows):
+    """construct + .realdate cost before enabling, while enabled and after disabling"""
+    realdates = sample_realdates(rows)
+    def work():
+        return [tzaware_datetime.TZAwareDateTime(realdate=d).realdate for d in realdates]
+    instrumentation = tzaware_datetime.instrumentation
+    results = {'off.seconds': best(work)}
+    instrumentation.enable()
+    results['on.seconds'] = best(work)
+    instrumentation.disable()
+    instrumentation.reset()
+    results['disabled_again.seconds'] = best(work)
+    return results
+
+def bench_named_zones(rows):
+    """.realdate rebuild cost: fixed offset vs named zone (prewarmed) vs gettz per row"""
+    values = [tzaware_datetime.NamedZoneTZAwareDateTime(realdate=d).__composite_values__()
+              for d in sample_realdates(rows)]
+    tzaware_datetime.tzinfo_registry.prewarm(set(v[1] for v in values))
+    results = {}
+    results['fixed_offset.seconds'] = best(
+        lambda: [tzaware_datetime.TZAwareDateTime(*v).realdate for v in values])
+    results['named_zone.seconds'] = best(
+        lambda: [tzaware_datetime.NamedZoneTZAwareDateTime(*v).realdate for v in values])
+    utc = tz.tzutc()
+    results['gettz_per_row.seconds'] = timed(
+        lambda: [v[0].replace(tzinfo=utc).astimezone(tz.gettz(v[1])) for v in values])[0]
+    return results
+
+def bench_ingest_iso(rows):
+    """rows/second parsing ISO-8601 strings: dateutil per row vs ingest.triples per process count"""
+    timestamps = [d.isoformat() for d in sample_realdates(rows)]
+    results = {'cpus': multiprocessing.cpu_count()}
+    results['dateutil.rows_per_second'] = rows / timed(
+        lambda: list(tzaware_datetime.bulk.composite_values(tz_parse(t) for t in timestamps)))[0]
+    for processes in (1, 2, 4):
+        results['processes_%d.rows_per_second' % processes] = rows / timed(
+            lambda: list(tzaware_datetime.ingest.triples(timestamps, processes=processes)))[0]
+    return results
+
+class DictPickledTZAwareDateTime(tzaware_datetime.TZAwareDateTime):
+    """TZAwareDateTime pickled the default way, through its instance __dict__"""
+    __reduce__ = object.__reduce__
+
+def bench_serialization(rows):
+    """bytes and seconds to serialize cached values: instance __dict__ pickle vs __reduce__ vs packed"""
+    values = [tzaware_datetime.TZAwareDateTime(realdate=d) for d in sample_realdates(rows)]
+    for value in values:
+        value.realdate
+    # what pickle stored before __reduce__: the instance dict, cached realdate and tzinfo included
+    unreduced = [DictPickledTZAwareDateTime(*value.__composite_values__()) for value in values]
+    for value in unreduced:
+        value.realdate
+    results = {}
+    for name, dumps, loads in (
+            ('instance_dict', lambda: cPickle.dumps(unreduced, 2), cPickle.loads),
+            ('reduce', lambda: cPickle.dumps(values, 2), cPickle.loads),
+            ('packed', lambda: tzaware_datetime.packed.encode(values),
+             tzaware_datetime.packed.decode)):
+        payload = dumps()
+        results[name + '.bytes'] = len(payload)
+        results[name + '.dumps_seconds'] = best(dumps)
+        results[name + '.loads_seconds'] = best(lambda: loads(payload))
+    return results
+
+def bench_change_tracking(rows):
+    """flush after editing 10% of loaded rows in place (.realdate) and 10% by replacing the value"""
+    realdates = sample_realdates(rows)
+    engine = create_engine('sqlite:///:memory:')
+    table_infomatic = prep_table(engine)
+    tzaware_datetime.bulk.insert(engine, table_infomatic, 'tzawaredate', realdates)
+    mapper(InfoMatic, table_infomatic, properties={
+        'tzawaredate': tzaware_datetime.helper.get_mapper_definition(table_infomatic,
+                                                                     'tzawaredate')})
+    session = create_session(bind=engine)
+    results = {}
+    for hours, label, edit in (
+            (1, 'in_place', lambda infomatic, d: setattr(infomatic.tzawaredate, 'realdate', d)),
+            (2, 'replaced', lambda infomatic, d:
+             setattr(infomatic, 'tzawaredate', tzaware_datetime.TZAwareDateTime(realdate=d)))):
+        session.begin()
+        loaded = session.query(InfoMatic).order_by(InfoMatic.id).all()
+        for infomatic, d in islice(zip(loaded, realdates), 0, None, 10):
+            edit(infomatic, d + datetime.timedelta(hours=hours))
+        results['%s.dirty_rows' % label] = len(session.dirty)
+        results['%s.flush_seconds' % label] = timed(session.commit)[0]
+        session.expunge_all()
+    session.close()
+    clear_mappers()
+    return results
+
+def bench_local_buckets(rows):
+    """count rows per local day: load and bucket .realdate in Python vs GROUP BY in SQLite"""
+    realdates = sample_realdates(rows)
+    engine = create_engine('sqlite:///:memory:')
+    table_infomatic = prep_table(engine)
+    tzaware_datetime.bulk.insert(engine, table_infomatic, 'tzawaredate', realdates)
+    mapper(InfoMatic, table_infomatic, properties={
+        'tzawaredate': tzaware_datetime.helper.get_mapper_definition(table_infomatic,
+                                                                     'tzawaredate')})
+    session = create_session(bind=engine)
+    def python_buckets():
+        counts = {}
+        for infomatic in session.query(InfoMatic):
+            day = infomatic.tzawaredate.realdate.date()
+            counts[day] = counts.get(day, 0) + 1
+        session.expunge_all()
+        return counts
+    day = InfoMatic.tzawaredate.local_date()
+    results = {'python.seconds': best(python_buckets),
+               'sql.seconds': best(lambda: session.query(day, func.count(InfoMatic.id))
+                                   .group_by(day).all())}
+    session.close()
+    clear_mappers()
+    return results
+
+def bench_partitions(rows):
+    """one-week range read: single indexed table vs monthly TimePartitionedTable, over two years"""
+    utc = tz.tzutc()
+    start = datetime.datetime(2010, 1, 1, tzinfo=utc)
+    step = datetime.timedelta(days=730) // rows
+    realdates = [start + step * n for n in xrange(rows)]
+    low = datetime.datetime(2011, 3, 10, tzinfo=utc)
+    high = low + datetime.timedelta(days=7)
+    results = {}
+
+    engine = create_engine('sqlite:///:memory:')
+    table_infomatic = prep_table(engine, index=True)
+    results['single.insert_seconds'] = timed(
+        tzaware_datetime.bulk.insert, engine, table_infomatic, 'tzawaredate', realdates)[0]
+    column_utcdate = table_infomatic.c.tzawaredate_utcdate
+    ranged = select([table_infomatic], (column_utcdate >= low.replace(tzinfo=None)) &
+                                       (column_utcdate < high.replace(tzinfo=None)))
+    results['single.range_seconds'] = best(lambda: engine.execute(ranged).fetchall())
+
+    engine = create_engine('sqlite:///:memory:')
+    partitioned = tzaware_datetime.TimePartitionedTable(
+        MetaData(), 'infomatic', 'tzawaredate',
+        [Column('id', Integer, primary_key=True), Column('info', Unicode(255))], index=True)
+    results['partitioned.insert_seconds'] = timed(partitioned.insert, engine, realdates)[0]
+    results['partitioned.range_seconds'] = best(
+        lambda: engine.execute(partitioned.select(low, high)).fetchall())
+    results['partitioned.stream_seconds'] = best(
+        lambda: list(partitioned.stream(engine, low, high)))
+    return results
+
+def bench_mostly_utc(rows):
+    """TZAwareDateTime(realdate=...) and .realdate on data that is 90% UTC"""
+    utc = tz.tzutc()
+    rome = tz.gettz('Europe/Rome')
+    start = datetime.datetime(2010, 1, 1)
+    realdates = [(start + datetime.timedelta(minutes=n)).replace(tzinfo=rome if n % 10 == 0 else utc)
+                 for n in xrange(rows)]
+    values = [tzaware_datetime.TZAwareDateTime(realdate=d).__composite_values__() for d in realdates]
+    results = {}
+    results['construct.seconds'] = best(
+        lambda: [tzaware_datetime.TZAwareDateTime(realdate=d) for d in realdates])
+    results['realdate.seconds'] = best(
+        lambda: [tzaware_datetime.TZAwareDateTime(*v).realdate for v in values])
+    return results
+
+def bench_columnstore(rows):
+    """export: ORM objects to CSV vs columnstore.export; reload: mapped chunk views vs CSV parse"""
+    realdates = sample_realdates(rows)
+    engine = create_engine('sqlite:///:memory:')
+    table_infomatic = prep_table(engine)
+    tzaware_datetime.bulk.insert(engine, table_infomatic, 'tzawaredate', realdates)
+    mapper(InfoMatic, table_infomatic, properties={
+        'tzawaredate': tzaware_datetime.helper.get_mapper_definition(table_infomatic,
+                                                                     'tzawaredate')})
+    session = create_session(bind=engine)
+    tempdir = tempfile.mkdtemp()
+    csvpath = os.path.join(tempdir, 'export.csv')
+    storepath = os.path.join(tempdir, 'export.tzcs')
+    results = {}
+    try:
+        def csv_export():
+            with open(csvpath, 'wb') as fileobj:
+                writer = csv.writer(fileobj)
+                for infomatic in session.query(InfoMatic).order_by(InfoMatic.id):
+                    writer.writerow([infomatic.tzawaredate.realdate.isoformat()])
+            session.expunge_all()
+        results['csv.export_seconds'] = timed(csv_export)[0]
+        results['csv.bytes'] = os.path.getsize(csvpath)
+        results['csv.reload_seconds'] = best(
+            lambda: [tz_parse(row[0]) for row in csv.reader(open(csvpath, 'rb'))])
+
+        results['columnstore.export_seconds'] = timed(
+            tzaware_datetime.columnstore.export, engine, table_infomatic, 'tzawaredate',
+            storepath, None, table_infomatic.c.id)[0]
+        results['columnstore.bytes'] = os.path.getsize(storepath)
+        def reload_views():
+            with tzaware_datetime.ColumnStoreFile(storepath) as stored:
+                return [columns for columns in stored.chunks()]
+        results['columnstore.reload_views_seconds'] = best(reload_views)
+        def reload_triples():
+            with tzaware_datetime.ColumnStoreFile(storepath) as stored:
+                return list(stored.triples())
+        results['columnstore.reload_triples_seconds'] = best(reload_triples)
+    finally:
+        shutil.rmtree(tempdir)
+        session.close()
+        clear_mappers()
+    return results
+
+SCHEMA_TABLES = 500
+SCHEMA_TIMESTAMPS = 3
+
+def column_copy_helpers(table, columnname):
+    """append_columns + get_mapper_definition as written before helper.declare:
+    copy and rename each template column, then scan the table for the three keys"""
+    for c in tzaware_datetime.TZAwareDateTimeColumns:
+        newcolumn = c.copy()
+        newcolumn.name = '%s_%s' % (columnname, c.name)
+        newcolumn.key = '%s_%s' % (columnname, c.key)
+        table.append_column(newcolumn)
+    keys = ['%s_%s' % (columnname, key) for key in tzaware_datetime.TZAwareDateTimeColumnNames]
+    found = dict((c.key, c) for c in table.c if c.key in keys)
+    return composite(tzaware_datetime.TZAwareDateTime, *[found[key] for key in keys],
+                     **dict(comparator_factory=tzaware_datetime.TZAwareDateTimeComparator))
+
+def bench_schema_setup(rows):
+    """startup for a synthetic 500-table schema with 3 TZAwareDateTime columns per table
+
+    rows is not used: the schema size is fixed."""
+    def classic():
+        metadata = MetaData()
+        for n in xrange(SCHEMA_TABLES):
+            table = Table('table%d' % n, metadata, Column('id', Integer, primary_key=True),
+                          Column('info', Unicode(255)))
+            for m in xrange(SCHEMA_TIMESTAMPS):
+                tzaware_datetime.helper.append_columns(table, 'stamp%d' % m)
+            mapper(type('Mapped%d' % n, (object,), {}), table, properties=dict(
+                ('stamp%d' % m, tzaware_datetime.helper.get_mapper_definition(table, 'stamp%d' % m))
+                for m in xrange(SCHEMA_TIMESTAMPS)))
+        compile_mappers()
+    def declarative():
+        Base = declarative_base()
+        for n in xrange(SCHEMA_TABLES):
+            attributes = {'__tablename__': 'table%d' % n,
+                          'id': Column(Integer, primary_key=True),
+                          'info': Column(Unicode(255))}
+            for m in xrange(SCHEMA_TIMESTAMPS):
+                attributes['stamp%d' % m] = tzaware_datetime.helper.declare('stamp%d' % m)
+            type('Declared%d' % n, (Base,), attributes)
+        compile_mappers()
+    results = {}
+    for label, setup in (('classic', classic), ('declarative', declarative)):
+        results[label + '.seconds'] = timed(setup)[0]
+        clear_mappers()
+    # the part spent in this module, without mapper(): the helpers against the
+    # column-copying code they replaced (both mostly construct SQLAlchemy Columns)
+    def helpers_only(define):
+        metadata = MetaData()
+        for n in xrange(SCHEMA_TABLES):
+            table = Table('table%d' % n, metadata, Column('id', Integer, primary_key=True))
+            for m in xrange(SCHEMA_TIMESTAMPS):
+                define(table, 'stamp%d' % m)
+    def helpers(table, columnname):
+        tzaware_datetime.helper.append_columns(table, columnname)
+        return tzaware_datetime.helper.get_mapper_definition(table, columnname)
+    results['helpers_only.seconds'] = best(lambda: helpers_only(helpers))
+    results['column_copy_helpers.seconds'] = best(lambda: helpers_only(column_copy_helpers))
+    return results
+
+# name: benchmark function taking the number of rows
+BENCHMARKS = [('construction', bench_construction),
+              ('realdate', bench_realdate),
+              ('composite_values', bench_composite_values),
+              ('tzinfo_registry', bench_tzinfo_registry),
+              ('instance_memory', bench_instance_memory),
+              ('orm', bench_orm),
+              ('ingest', bench_ingest),
+              ('arrays', bench_arrays),
+              ('storage_layouts', bench_storage_layouts),
+              ('instrumentation', bench_instrumentation),
+              ('named_zones', bench_named_zones),
+              ('ingest_iso', bench_ingest_iso),
+              ('serialization', bench_serialization),
+              ('change_tracking', bench_change_tracking),
+              ('local_buckets', bench_local_buckets),
+              ('partitions', bench_partitions),
+              ('schema_setup', bench_schema_setup),
+              ('mostly_utc', bench_mostly_utc),
+              ('columnstore', bench_columnstore)]
+
+def environment():
+    """interpreter and library versions recorded with every run"""
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'dateutil': getattr(dateutil, '__version__', None),
+            'numpy': tzaware_datetime.numpy and tzaware_datetime.numpy.__version__,
+            'tzaware_datetime': tzaware_datetime.__version__,
+            'timestamp': datetime.datetime.utcnow().isoformat()}
+
+def run_all_benchmarks(sizes=DEFAULT_SIZES, only=None, output=None):
+    """run the benchmarks for every size; print a summary and optionally write JSON"""
+    results = []
+    for name, benchmark in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for rows in sizes:
+            metrics = benchmark(rows)
+            results.append({'benchmark': name, 'rows': rows, 'metrics': metrics})
+            print '%s (%s rows)' % (name, rows)
+            for metric, value in sorted(metrics.items()):
+                print '\t%-40s %14.6g' % (metric, value)
+    report = {'environment': environment(), 'results': results}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark tzaware_datetime')
+    parser.add_argument('--rows', default=','.join(str(n) for n in DEFAULT_SIZES),
+                        help='comma-separated data sizes (default: %(default)s)')
+    parser.add_argument('--only', default='',
+                        help='comma-separated benchmark names (default: all of %s)'
+                             % ', '.join(name for name, benchmark in BENCHMARKS))
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args(argv)
+    only = [name for name in args.only.split(',') if name]
+    unknown = set(only) - set(name for name, benchmark in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: %s' % ', '.join(sorted(unknown)))
+    run_all_benchmarks([int(n) for n in args.rows.split(',')], only, args.output)
+
+if __name__ == '__main__':
+    main()
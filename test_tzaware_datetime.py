@@ -12,15 +12,25 @@ __copyright__ = "Public Domain (CC0) <http://creativecommons.org/publicdomain/ze
 # stdlib
 import unittest
 import datetime
+import threading
+import gc
+import tempfile
+import shutil
+import os
+import pickle
+import struct
 
 # 3rd-party
 import dateutil
 
 # sqlalchemy
+import sqlalchemy.exc
 from sqlalchemy import MetaData, Table, Column, DateTime, Unicode, Integer
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, engine, select, func
 from sqlalchemy.orm import mapper, relation, composite, create_session, clear_mappers
 from sqlalchemy.orm import CompositeProperty
+from sqlalchemy.interfaces import ConnectionProxy
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
 
 # module to test
 import tzaware_datetime
@@ -108,6 +118,199 @@ class TestBasicClass(unittest.TestCase):
         else:
             return 86400 - tdelta.seconds
 
+class TestRealdateCache(unittest.TestCase):
+    """.realdate is computed once and recomputed after any composite value changes"""
+    def setUp(self):
+        self.firstdate = datetime.datetime(2010, 1, 15, 8, tzinfo=dateutil.tz.gettz('Europe/Rome'))
+        self.seconddate = datetime.datetime(2010, 6, 15, 8, tzinfo=dateutil.tz.gettz('America/Toronto'))
+        self.tzadt = tzaware_datetime.TZAwareDateTime(realdate=self.firstdate)
+
+    def test_cached(self):
+        """Repeated reads return the same object"""
+        self.assertTrue(self.tzadt.realdate is self.tzadt.realdate)
+        self.assertEqual(self.firstdate, self.tzadt.realdate)
+
+    def test_realdate_setter(self):
+        """Setting .realdate clears the cache"""
+        self.assertEqual(self.firstdate, self.tzadt.realdate)
+        self.tzadt.realdate = self.seconddate
+        self.assertEqual(self.seconddate, self.tzadt.realdate)
+
+    def test_set_composite_values(self):
+        """__set_composite_values__ clears the cache"""
+        self.assertEqual(self.firstdate, self.tzadt.realdate)
+        other = tzaware_datetime.TZAwareDateTime(realdate=self.seconddate)
+        self.tzadt.__set_composite_values__(*other.__composite_values__())
+        self.assertEqual(self.seconddate, self.tzadt.realdate)
+        self.tzadt.__set_composite_values__(None, None, None)
+        self.assertEqual(None, self.tzadt.realdate)
+
+    def test_attribute_assignment(self):
+        """Assigning utcdt, offsetseconds or tzname clears the cache"""
+        self.assertEqual(self.firstdate, self.tzadt.realdate)
+        self.tzadt.utcdt = self.seconddate.astimezone(dateutil.tz.tzutc())
+        self.assertEqual(self.seconddate, self.tzadt.realdate)
+
+        cached = self.tzadt.realdate
+        self.tzadt.offsetseconds = 0
+        self.assertEqual(datetime.timedelta(0), self.tzadt.realdate.utcoffset())
+        self.assertFalse(cached is self.tzadt.realdate)
+
+        cached = self.tzadt.realdate
+        self.tzadt.tzname = u'UTC'
+        self.assertFalse(cached is self.tzadt.realdate)
+
+    def test_none_cached(self):
+        """An empty value caches None and recomputes once populated"""
+        empty = tzaware_datetime.TZAwareDateTime()
+        self.assertEqual(None, empty.realdate)
+        empty.utcdt = datetime.datetime(2010, 1, 15, 9, 45)
+        self.assertEqual(datetime.datetime(2010, 1, 15, 9, 45, tzinfo=dateutil.tz.tzutc()),
+                         empty.realdate)
+
+class TestTZInfoRegistry(unittest.TestCase):
+    """shared tzinfo objects"""
+    def test_shared_offset(self):
+        """Equal offsets resolve to the same tzinfo object"""
+        registry = tzaware_datetime.TZInfoRegistry()
+        self.assertTrue(registry.offset(3600) is registry.offset(3600))
+        self.assertFalse(registry.offset(3600) is registry.offset(-3600))
+        self.assertFalse(registry.offset(3600) is registry.offset(3600, u'CET'))
+        self.assertEqual(datetime.timedelta(hours=1),
+                         registry.offset(3600).utcoffset(datetime.datetime(2010, 1, 1)))
+
+    def test_shared_zone(self):
+        """Zone names resolve once"""
+        registry = tzaware_datetime.TZInfoRegistry()
+        self.assertTrue(registry.zone('Europe/Rome') is registry.zone('Europe/Rome'))
+
+    def test_stats(self):
+        """Hits and misses are counted"""
+        registry = tzaware_datetime.TZInfoRegistry()
+        registry.offset(0)
+        registry.offset(0)
+        registry.offset(60)
+        self.assertEqual({'hits': 1, 'misses': 2, 'size': 2, 'maxsize': 1024},
+                         registry.stats())
+        registry.clear()
+        self.assertEqual({'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 1024},
+                         registry.stats())
+
+    def test_lru_eviction(self):
+        """Least recently used entries are evicted at maxsize"""
+        registry = tzaware_datetime.TZInfoRegistry(maxsize=2)
+        first = registry.offset(60)
+        registry.offset(120)
+        registry.offset(60)
+        registry.offset(180)
+        self.assertEqual(2, registry.stats()['size'])
+        self.assertTrue(first is registry.offset(60))
+        self.assertEqual(3, registry.stats()['misses'])
+        registry.offset(120)
+        self.assertEqual(4, registry.stats()['misses'])
+
+    def test_disabled(self):
+        """maxsize=0 keeps nothing: every lookup is a miss"""
+        registry = tzaware_datetime.TZInfoRegistry(maxsize=0)
+        self.assertEqual(datetime.timedelta(seconds=60), registry.offset(60).utcoffset(None))
+        self.assertEqual(datetime.timedelta(seconds=60), registry.offset(60).utcoffset(None))
+        self.assertEqual({'hits': 0, 'misses': 2, 'size': 0, 'maxsize': 0}, registry.stats())
+
+    def test_threads(self):
+        """Concurrent lookups return one shared object per offset"""
+        registry = tzaware_datetime.TZInfoRegistry(maxsize=16)
+        results = []
+        def lookup():
+            results.extend(registry.offset(n % 8 * 900) for n in range(500))
+        workers = [threading.Thread(target=lookup) for n in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(8, len(set(id(tzinfo) for tzinfo in results)))
+
+    def test_realdate_shares_tzinfo(self):
+        """Values with the same offset share a tzinfo"""
+        utcdt = datetime.datetime(2010, 1, 15, 8)
+        a = tzaware_datetime.TZAwareDateTime(utcdt, None, 3600)
+        b = tzaware_datetime.TZAwareDateTime(utcdt, None, 3600)
+        self.assertTrue(a.realdate.tzinfo is b.realdate.tzinfo)
+
+class TestSlottedVariants(unittest.TestCase):
+    """SlottedTZAwareDateTime and FrozenTZAwareDateTime"""
+    def setUp(self):
+        self.newdate = datetime.datetime(2010, 1, 15, 8, tzinfo=dateutil.tz.gettz('Europe/Rome'))
+
+    def tearDown(self):
+        clear_mappers()
+
+    def test_slotted(self):
+        """Slotted values have no __dict__ and behave like TZAwareDateTime"""
+        slotted = tzaware_datetime.SlottedTZAwareDateTime(realdate=self.newdate)
+        plain = tzaware_datetime.TZAwareDateTime(realdate=self.newdate)
+        self.assertFalse(hasattr(slotted, '__dict__'))
+        self.assertEqual(plain.__composite_values__(), slotted.__composite_values__())
+        self.assertEqual(self.newdate, slotted.realdate)
+        slotted.__set_composite_values__(None, None, None)
+        self.assertEqual(None, slotted.realdate)
+
+    def test_frozen_immutable(self):
+        """Frozen values reject modification"""
+        frozen = tzaware_datetime.FrozenTZAwareDateTime(realdate=self.newdate)
+        self.assertEqual(self.newdate, frozen.realdate)
+        self.assertFalse(hasattr(frozen, '__dict__'))
+        self.assertRaises(AttributeError, setattr, frozen, 'utcdt', None)
+        self.assertRaises(AttributeError, setattr, frozen, 'realdate', self.newdate)
+        self.assertRaises(TypeError, frozen.__set_composite_values__, None, None, None)
+
+    def test_frozen_hash_and_order(self):
+        """Frozen values dedupe and sort by UTC instant, whatever the offset"""
+        Frozen = tzaware_datetime.FrozenTZAwareDateTime
+        rome = Frozen(realdate=self.newdate)
+        london = Frozen(realdate=self.newdate.astimezone(dateutil.tz.gettz('Europe/London')))
+        fromdb = Frozen(self.newdate.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None),
+                        None, -3600)
+        later = Frozen(realdate=self.newdate + datetime.timedelta(hours=1))
+        empty = Frozen()
+        self.assertEqual(rome, london)
+        self.assertEqual(rome, fromdb)
+        self.assertEqual(hash(rome), hash(fromdb))
+        self.assertEqual(2, len(set([rome, london, fromdb, later])))
+        self.assertEqual([empty, rome, later], sorted([later, rome, empty]))
+        self.assertTrue(rome < later)
+        self.assertTrue(later >= london)
+        self.assertTrue(rome == tzaware_datetime.TZAwareDateTime(realdate=self.newdate))
+        self.assertEqual({rome: 'x'}[fromdb], 'x')
+
+    def test_database_roundtrip(self):
+        """Both variants work as composite classes"""
+        db_engine = create_engine('sqlite:///:memory:', echo=False)
+        for composite_class in (tzaware_datetime.SlottedTZAwareDateTime,
+                                tzaware_datetime.FrozenTZAwareDateTime):
+            db_metadata = MetaData()
+            table_infomatic = Table('infomatic_%s' % composite_class.__name__, db_metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('info', Unicode(255)),
+                              Column('utcdate', DateTime),
+                              Column('tzname', Unicode),
+                              Column('tzoffset', Integer))
+            mapper(InfoMatic, table_infomatic, properties={
+                'tzawaredate': composite(composite_class,
+                                         table_infomatic.c.utcdate,
+                                         table_infomatic.c.tzname,
+                                         table_infomatic.c.tzoffset)
+            })
+            db_metadata.create_all(db_engine)
+            session = create_session(bind=db_engine, autocommit=True, autoflush=True)
+            session.add(InfoMatic(u'slotted', composite_class(realdate=self.newdate)))
+            session.flush()
+            session.expunge_all()
+            fromdb = session.query(InfoMatic).first().tzawaredate
+            self.assertTrue(isinstance(fromdb, composite_class))
+            self.assertEqual(self.newdate, fromdb.realdate)
+            session.close()
+            clear_mappers()
+
 class TestDatabaseAccess(unittest.TestCase):
     """Test TZAwareDateTime within a sqlalchemy database"""
     def setUp(self):
@@ -177,6 +380,87 @@ class TestDatabaseAccess(unittest.TestCase):
         self.assertTrue(dates_in_order[0].tzawaredate.realdate == dates_to_add['Rome'][1])
         self.assertTrue(dates_in_order[2].tzawaredate.realdate == dates_to_add['Toronto'][1])
         
+class TestComparator(unittest.TestCase):
+    """comparisons on helper-built composites use the UTC column alone"""
+    def setUp(self):
+        self.db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        self.db_metadata = MetaData()
+        self.table_infomatic = Table('infomatic', self.db_metadata,
+                                     Column('id', Integer, primary_key=True),
+                                     Column('info', Unicode(255)),
+                                     Column('expectedoffset', Integer))
+        tzaware_datetime.helper.append_columns(self.table_infomatic, 'tzawaredate')
+        mapper(InfoMatic, self.table_infomatic, properties={
+            'tzawaredate': tzaware_datetime.helper.get_mapper_definition(self.table_infomatic,
+                                                                         'tzawaredate')
+        })
+        self.db_metadata.create_all(self.db_myengine)
+        self.session = create_session(bind=self.db_myengine, autocommit=True, autoflush=True)
+
+        # 06:00 local: Toronto is 11:00 UTC, London 06:00 UTC, Rome 05:00 UTC
+        self.dates = {}
+        for info, zone in ((u'Rome', 'Europe/Rome'),
+                           (u'London', 'Europe/London'),
+                           (u'Toronto', 'America/Toronto')):
+            self.dates[info] = datetime.datetime(2010, 1, 20, 6, tzinfo=dateutil.tz.gettz(zone))
+            self.session.add(InfoMatic(info, tzaware_datetime.TZAwareDateTime(realdate=self.dates[info])))
+        self.session.flush()
+
+    def tearDown(self):
+        self.session.close()
+        clear_mappers()
+
+    def query_info(self, *criteria):
+        query = self.session.query(InfoMatic)
+        for criterion in criteria:
+            query = query.filter(criterion)
+        return [i.info for i in query.order_by(InfoMatic.tzawaredate)]
+
+    def test_sql_uses_utc_column_only(self):
+        """Compiled comparisons and ORDER BY reference only the utcdate column"""
+        for clause in (InfoMatic.tzawaredate < self.dates['Rome'],
+                       InfoMatic.tzawaredate == self.dates['Rome'],
+                       InfoMatic.tzawaredate.between(self.dates['Rome'], self.dates['Toronto']),
+                       InfoMatic.tzawaredate.desc()):
+            sql = str(clause)
+            self.assertTrue('tzawaredate_utcdate' in sql, sql)
+            self.assertFalse('tzawaredate_tzname' in sql, sql)
+            self.assertFalse('tzawaredate_tzoffset' in sql, sql)
+        sql = str(self.session.query(InfoMatic).order_by(InfoMatic.tzawaredate).statement)
+        self.assertTrue(sql.endswith('ORDER BY infomatic.tzawaredate_utcdate'), sql)
+
+    def test_order_by(self):
+        """Results sort by UTC instant"""
+        self.assertEqual([u'Rome', u'London', u'Toronto'], self.query_info())
+        self.assertEqual([u'Toronto', u'London', u'Rome'],
+                         [i.info for i in self.session.query(InfoMatic).\
+                              order_by(InfoMatic.tzawaredate.desc())])
+
+    def test_range(self):
+        """Range operators accept aware datetimes and TZAwareDateTime values"""
+        london = self.dates['London']
+        self.assertEqual([u'Rome'], self.query_info(InfoMatic.tzawaredate < london))
+        self.assertEqual([u'Rome', u'London'], self.query_info(InfoMatic.tzawaredate <= london))
+        self.assertEqual([u'Toronto'], self.query_info(InfoMatic.tzawaredate > london))
+        self.assertEqual([u'London', u'Toronto'],
+                         self.query_info(InfoMatic.tzawaredate >=
+                                         tzaware_datetime.TZAwareDateTime(realdate=london)))
+        self.assertEqual([u'Rome', u'London'],
+                         self.query_info(InfoMatic.tzawaredate.between(
+                             self.dates['Rome'], london.astimezone(dateutil.tz.gettz('Asia/Tokyo')))))
+
+    def test_equality(self):
+        """Equality matches the instant regardless of operand timezone"""
+        rome_in_utc = self.dates['Rome'].astimezone(dateutil.tz.tzutc())
+        self.assertEqual([u'Rome'], self.query_info(InfoMatic.tzawaredate == rome_in_utc))
+        self.assertEqual([u'London', u'Toronto'],
+                         self.query_info(InfoMatic.tzawaredate != rome_in_utc))
+        self.assertEqual([], self.query_info(InfoMatic.tzawaredate == None))
+
+    def test_naive_operand(self):
+        """Naive datetimes are rejected"""
+        self.assertRaises(ValueError, lambda: InfoMatic.tzawaredate < datetime.datetime(2010, 1, 1))
+
 class TestDatabaseSetupHelper(unittest.TestCase):
     """test the TZAwareDateTime sqlalchemy setup helpers"""
     def setUp(self):
@@ -255,6 +539,54 @@ class TestDatabaseSetupHelper(unittest.TestCase):
             columndefinition = tzaware_datetime.helper.get_mapper_definition(table_infomatic, datecolumnname)
             self.assertTrue(isinstance(columndefinition, CompositeProperty))
 
+    def test_missing_columns(self):
+        """get_mapper_definition names the missing column"""
+        table_infomatic = Table('infomatic', MetaData(), Column('id', Integer, primary_key=True))
+        self.assertRaises(KeyError, tzaware_datetime.helper.get_mapper_definition,
+                          table_infomatic, 'newdate')
+
+    def test_declarative(self):
+        """helper.declare defines columns and composite in declarative classes and mixins"""
+        Base = declarative_base()
+        class CreatedMixin(object):
+            @declared_attr
+            def created(cls):
+                return tzaware_datetime.helper.declare('created', index=True)
+        class Event(CreatedMixin, Base):
+            __tablename__ = 'event'
+            id = Column(Integer, primary_key=True)
+            changed = tzaware_datetime.helper.declare(
+                'changed', composite_class=tzaware_datetime.NamedZoneTZAwareDateTime)
+            stamped = tzaware_datetime.helper.declare('stamped', storage='epoch')
+
+        # same columns and index as append_columns
+        table_infomatic = Table('event', MetaData(), Column('id', Integer, primary_key=True))
+        for columnname, storage in (('created', 'datetime'), ('changed', 'datetime'),
+                                    ('stamped', 'epoch')):
+            tzaware_datetime.helper.append_columns(table_infomatic, columnname, storage=storage,
+                                                   index=(columnname == 'created'))
+        self.assertEqual(sorted((c.key, c.name, type(c.type)) for c in table_infomatic.c),
+                         sorted((c.key, c.name, type(c.type)) for c in Event.__table__.c))
+        self.assertEqual(sorted(i.name for i in table_infomatic.indexes),
+                         sorted(i.name for i in Event.__table__.indexes))
+
+        db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        Base.metadata.create_all(db_myengine)
+        session = create_session(bind=db_myengine)
+        newdate = datetime.datetime(2010, 1, 20, 6, tzinfo=dateutil.tz.gettz('America/Toronto'))
+        event = Event()
+        event.created = tzaware_datetime.TZAwareDateTime(realdate=newdate)
+        event.changed = tzaware_datetime.NamedZoneTZAwareDateTime(realdate=newdate)
+        event.stamped = tzaware_datetime.EpochTZAwareDateTime(realdate=newdate)
+        session.add(event)
+        session.flush()
+        session.expunge_all()
+        event = session.query(Event).filter(Event.created == newdate).one()
+        self.assertEqual(newdate, event.created.realdate)
+        self.assertEqual(u'America/Toronto', event.changed.tzname)
+        self.assertEqual(newdate, event.stamped.realdate)
+        session.close()
+
     def test_whole_enchilada(self):
         """test entire database"""
         # create engine
@@ -285,6 +617,1306 @@ class TestDatabaseSetupHelper(unittest.TestCase):
         # properly clear sqlalchemy in-memory values
         session.close()
         
+class TestIndexes(unittest.TestCase):
+    """indexes created by helper.append_columns, checked against SQLite query plans"""
+    def setUp(self):
+        self.db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        self.db_metadata = MetaData()
+        self.table_event = Table('event', self.db_metadata,
+                                 Column('id', Integer, primary_key=True),
+                                 Column('tenant_id', Integer),
+                                 Column('info', Unicode(255)))
+
+    def create_table(self, **kwargs):
+        tzaware_datetime.helper.append_columns(self.table_event, 'thedate', **kwargs)
+        self.db_metadata.create_all(self.db_myengine)
+        return sorted(i.name for i in self.table_event.indexes)
+
+    def query_plan(self, sql):
+        rows = self.db_myengine.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+        return ' '.join(str(tuple(row)[-1]) for row in rows)
+
+    def test_no_index_by_default(self):
+        """No index unless asked for"""
+        self.assertEqual([], self.create_table())
+
+    def test_utc_index(self):
+        """Range and ORDER BY queries use the UTC index"""
+        self.assertEqual(['ix_event_thedate_utcdate'], self.create_table(index=True))
+        plan = self.query_plan("SELECT * FROM event WHERE thedate_utcdate > '2010-01-01'")
+        self.assertTrue('USING INDEX ix_event_thedate_utcdate' in plan, plan)
+        plan = self.query_plan('SELECT * FROM event ORDER BY thedate_utcdate')
+        self.assertTrue('USING INDEX ix_event_thedate_utcdate' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+    def test_composite_index(self):
+        """Composite indexes lead with the given columns"""
+        self.assertEqual(['ix_event_tenant_id_thedate_utcdate'],
+                         self.create_table(composite_indexes=[('tenant_id',)]))
+        plan = self.query_plan("SELECT * FROM event WHERE tenant_id = 1 "
+                               "AND thedate_utcdate BETWEEN '2010-01-01' AND '2010-02-01' "
+                               "ORDER BY thedate_utcdate")
+        self.assertTrue('USING INDEX ix_event_tenant_id_thedate_utcdate' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+    def test_covering_index(self):
+        """Covering indexes answer UTC date and offset reads from the index alone"""
+        self.assertEqual(['ix_event_tenant_id_thedate_utcdate_thedate_tzoffset',
+                          'ix_event_thedate_utcdate_thedate_tzoffset'],
+                         self.create_table(index=True, composite_indexes=[('tenant_id',)],
+                                           covering=True))
+        plan = self.query_plan("SELECT thedate_utcdate, thedate_tzoffset FROM event "
+                               "WHERE thedate_utcdate > '2010-01-01' ORDER BY thedate_utcdate")
+        self.assertTrue('USING COVERING INDEX ix_event_thedate_utcdate_thedate_tzoffset' in plan,
+                        plan)
+
+    def test_covering_needs_index(self):
+        """covering without an index to extend is refused"""
+        self.assertRaises(ValueError, tzaware_datetime.helper.append_columns,
+                          self.table_event, 'thedate', covering=True)
+        self.assertEqual([], list(self.table_event.columns.keys())[3:])
+
+    def test_unknown_column(self):
+        """Composite index columns must exist in the table"""
+        self.assertRaises(KeyError, tzaware_datetime.helper.append_columns,
+                          self.table_event, 'thedate', composite_indexes=[('missing',)])
+        self.assertEqual(['id', 'tenant_id', 'info'], list(self.table_event.columns.keys()))
+
+class TestBulk(unittest.TestCase):
+    """Core bulk insert/update of TZAwareDateTime columns"""
+    def setUp(self):
+        self.db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        self.db_metadata = MetaData()
+        self.table_infomatic = Table('infomatic', self.db_metadata,
+                                     Column('id', Integer, primary_key=True),
+                                     Column('info', Unicode(255)),
+                                     Column('expectedoffset', Integer))
+        tzaware_datetime.helper.append_columns(self.table_infomatic, 'tzawaredate')
+        mapper(InfoMatic, self.table_infomatic, properties={
+            'tzawaredate': tzaware_datetime.helper.get_mapper_definition(self.table_infomatic,
+                                                                         'tzawaredate')
+        })
+        self.db_metadata.create_all(self.db_myengine)
+        self.session = create_session(bind=self.db_myengine, autocommit=True, autoflush=True)
+        self.dates = [datetime.datetime(2010, 1, 20, 6, tzinfo=dateutil.tz.gettz(zone))
+                      for zone in ('Europe/Rome', 'America/Toronto', 'Asia/Tokyo',
+                                   'Europe/London', 'Australia/Sydney')]
+
+    def tearDown(self):
+        self.session.close()
+        clear_mappers()
+
+    def stored(self):
+        return [i.tzawaredate for i in self.session.query(InfoMatic).order_by(InfoMatic.id)]
+
+    def test_composite_values(self):
+        """Triples match the ORM composite values"""
+        self.assertEqual([tuple(tzaware_datetime.TZAwareDateTime(realdate=d).__composite_values__())
+                          for d in self.dates] + [(None, None, None)],
+                         list(tzaware_datetime.bulk.composite_values(self.dates + [None])))
+
+    def test_insert_datetimes(self):
+        """Insert bare aware datetimes in chunks"""
+        count = tzaware_datetime.bulk.insert(self.db_myengine, self.table_infomatic,
+                                             'tzawaredate', iter(self.dates), chunksize=2)
+        self.assertEqual(5, count)
+        stored = self.stored()
+        self.assertEqual(self.dates, [t.realdate for t in stored])
+        self.assertEqual([tzaware_datetime.TZAwareDateTime(realdate=d).offsetseconds
+                          for d in self.dates],
+                         [t.offsetseconds for t in stored])
+
+    def test_insert_dicts(self):
+        """Insert row dicts with other column values"""
+        rows = [{'info': u'row %d' % n, 'tzawaredate': d} for n, d in enumerate(self.dates)]
+        rows.append({'info': u'empty', 'tzawaredate': None})
+        self.assertEqual(6, tzaware_datetime.bulk.insert(self.db_myengine, self.table_infomatic,
+                                                         'tzawaredate', rows))
+        infomatics = self.session.query(InfoMatic).order_by(InfoMatic.id).all()
+        self.assertEqual([u'row 0', u'row 1', u'row 2', u'row 3', u'row 4', u'empty'],
+                         [i.info for i in infomatics])
+        self.assertEqual(self.dates + [None], [i.tzawaredate.realdate for i in infomatics])
+        self.assertTrue('tzawaredate' in rows[0], 'input rows are not modified')
+
+    def test_update(self):
+        """Update by primary key"""
+        tzaware_datetime.bulk.insert(self.db_myengine, self.table_infomatic,
+                                     'tzawaredate', self.dates)
+        newdates = list(reversed(self.dates))
+        count = tzaware_datetime.bulk.update(self.db_myengine, self.table_infomatic, 'tzawaredate',
+                                             [{'id': n + 1, 'tzawaredate': d}
+                                              for n, d in enumerate(newdates)],
+                                             chunksize=3)
+        self.assertEqual(5, count)
+        self.assertEqual(newdates, [t.realdate for t in self.stored()])
+
+class TestArrays(unittest.TestCase):
+    """column-at-a-time conversion to and from arrays"""
+    def setUp(self):
+        self.dates = [datetime.datetime(2010, 1, 20, 6, tzinfo=dateutil.tz.gettz(zone))
+                      for zone in ('Europe/Rome', 'America/Toronto', 'Asia/Kolkata', 'UTC')]
+        values = [tzaware_datetime.TZAwareDateTime(realdate=d) for d in self.dates]
+        # as read back from the database: naive UTC
+        self.utcdates = [v.utcdt.replace(tzinfo=None) for v in values] + [None]
+        self.offsets = [v.offsetseconds for v in values] + [None]
+        self.localdates = [d.replace(tzinfo=None) for d in self.dates] + [None]
+
+    def test_from_columns_python(self):
+        """Pure-Python conversion"""
+        utc, offsets, local = tzaware_datetime.arrays.from_columns(self.utcdates, self.offsets,
+                                                                   use_numpy=False)
+        self.assertEqual(self.utcdates, utc)
+        self.assertEqual([-3600, 18000, -19800, 0, 0], offsets)
+        self.assertEqual(self.localdates, local)
+
+    @unittest.skipIf(tzaware_datetime.numpy is None, 'numpy not installed')
+    def test_from_columns_numpy(self):
+        """Vectorized conversion"""
+        numpy = tzaware_datetime.numpy
+        utc, offsets, local = tzaware_datetime.arrays.from_columns(self.utcdates, self.offsets)
+        self.assertEqual(numpy.dtype('datetime64[us]'), utc.dtype)
+        self.assertEqual(numpy.dtype('datetime64[us]'), local.dtype)
+        self.assertEqual(numpy.dtype('int32'), offsets.dtype)
+        self.assertEqual(self.utcdates, utc.tolist())
+        self.assertEqual([-3600, 18000, -19800, 0, 0], offsets.tolist())
+        self.assertEqual(self.localdates, local.tolist())
+
+    def test_to_columns(self):
+        """Arrays convert back to storage columns"""
+        for use_numpy in (True, False):
+            utc, offsets, local = tzaware_datetime.arrays.from_columns(self.utcdates, self.offsets,
+                                                                       use_numpy=use_numpy)
+            utcdates, tznames, offsets = tzaware_datetime.arrays.to_columns(utc, offsets)
+            self.assertEqual(self.utcdates, utcdates)
+            self.assertEqual([None] * 5, tznames)
+            self.assertEqual([-3600, 18000, -19800, 0, 0], offsets)
+            self.assertTrue(all(type(o) is int for o in offsets))
+        self.assertEqual([u'CET'], tzaware_datetime.arrays.to_columns(utc[:1], offsets[:1],
+                                                                      [u'CET'])[1])
+
+class TestStream(unittest.TestCase):
+    """streaming reads of TZAwareDateTime columns"""
+    def setUp(self):
+        self.db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        self.db_metadata = MetaData()
+        self.table_infomatic = Table('infomatic', self.db_metadata,
+                                     Column('id', Integer, primary_key=True),
+                                     Column('info', Unicode(255)))
+        tzaware_datetime.helper.append_columns(self.table_infomatic, 'tzawaredate')
+        self.db_metadata.create_all(self.db_myengine)
+        self.start = datetime.datetime(2010, 1, 20, 6, tzinfo=dateutil.tz.gettz('Europe/Rome'))
+
+    def insert(self, count):
+        tzaware_datetime.bulk.insert(self.db_myengine, self.table_infomatic, 'tzawaredate',
+                                     ({'info': u'row %d' % n,
+                                       'tzawaredate': self.start + datetime.timedelta(minutes=n)}
+                                      for n in xrange(count)))
+
+    def test_values(self):
+        """Yield TZAwareDateTime values, aware datetimes and extra columns"""
+        self.insert(5)
+        select = tzaware_datetime.stream.select
+        values = list(select(self.db_myengine, self.table_infomatic, 'tzawaredate', chunksize=2))
+        self.assertEqual(5, len(values))
+        self.assertTrue(all(isinstance(v, tzaware_datetime.TZAwareDateTime) for v in values))
+        self.assertEqual(self.start, values[0].realdate)
+
+        realdates = list(select(self.db_myengine, self.table_infomatic, 'tzawaredate',
+                                realdate=True, chunksize=2))
+        self.assertEqual([self.start + datetime.timedelta(minutes=n) for n in range(5)], realdates)
+
+        column_utcdate = self.table_infomatic.c.tzawaredate_utcdate
+        rows = list(select(self.db_myengine, self.table_infomatic, 'tzawaredate',
+                           columns=['info', self.table_infomatic.c.id],
+                           whereclause=column_utcdate > realdates[1].astimezone(dateutil.tz.tzutc()),
+                           order_by=column_utcdate.desc(), realdate=True))
+        self.assertEqual([(realdates[4], u'row 4', 5),
+                          (realdates[3], u'row 3', 4),
+                          (realdates[2], u'row 2', 3)], rows)
+
+    def max_live_values(self, count, chunksize):
+        """largest number of TZAwareDateTime and row objects alive while streaming count rows"""
+        self.insert(count)
+        watched = (tzaware_datetime.TZAwareDateTime, engine.RowProxy)
+        peak = 0
+        for n, value in enumerate(tzaware_datetime.stream.select(self.db_myengine,
+                                                                 self.table_infomatic,
+                                                                 'tzawaredate',
+                                                                 chunksize=chunksize)):
+            if n % (chunksize * 10) == chunksize - 1:
+                live = sum(1 for o in gc.get_objects() if isinstance(o, watched))
+                peak = max(peak, live)
+        return peak
+
+    def test_bounded_memory(self):
+        """Live objects depend on chunksize, not on result size"""
+        gc.collect()
+        small = self.max_live_values(500, 50)
+        self.db_myengine.execute(self.table_infomatic.delete())
+        gc.collect()
+        large = self.max_live_values(5000, 50)
+        self.assertTrue(large <= 2 * 50, large)
+        self.assertTrue(large <= small + 5, (small, large))
+
+class TestEpochStorage(unittest.TestCase):
+    """integer microseconds + offset storage layout"""
+    def setUp(self):
+        self.db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        self.db_metadata = MetaData()
+        self.table_infomatic = Table('infomatic', self.db_metadata,
+                                     Column('id', Integer, primary_key=True),
+                                     Column('info', Unicode(255)))
+        tzaware_datetime.helper.append_columns(self.table_infomatic, 'tzawaredate',
+                                               index=True, storage='epoch')
+        self.dates = {}
+        for info, zone in ((u'Rome', 'Europe/Rome'),
+                           (u'London', 'Europe/London'),
+                           (u'Toronto', 'America/Toronto')):
+            self.dates[info] = datetime.datetime(2010, 1, 20, 6, 0, 0, 123456,
+                                                 tzinfo=dateutil.tz.gettz(zone))
+
+    def tearDown(self):
+        clear_mappers()
+
+    def test_columns(self):
+        """Two integer columns, indexed on the UTC instant"""
+        self.assertEqual(['id', 'info', 'tzawaredate_utcmicros', 'tzawaredate_tzoffset'],
+                         [c.key for c in self.table_infomatic.c])
+        self.assertEqual(['ix_infomatic_tzawaredate_utcmicros'],
+                         [i.name for i in self.table_infomatic.indexes])
+        self.assertRaises(ValueError, tzaware_datetime.helper.append_columns,
+                          self.table_infomatic, 'otherdate', storage='packed')
+
+    def test_type(self):
+        """UTCMicroseconds stores integers and returns naive UTC datetimes"""
+        self.db_metadata.create_all(self.db_myengine)
+        utcdt = self.dates[u'Rome'].astimezone(dateutil.tz.tzutc())
+        self.db_myengine.execute(self.table_infomatic.insert(),
+                                 [{'tzawaredate_utcmicros': utcdt},
+                                  {'tzawaredate_utcmicros': utcdt.replace(tzinfo=None)},
+                                  {'tzawaredate_utcmicros': None}])
+        raw = self.db_myengine.execute('SELECT tzawaredate_utcmicros FROM infomatic '
+                                         'ORDER BY id').fetchall()
+        self.assertEqual([(1263963600123456,), (1263963600123456,), (None,)], raw)
+        values = self.db_myengine.execute(self.table_infomatic.select().\
+                                              order_by(self.table_infomatic.c.id)).fetchall()
+        self.assertEqual([utcdt.replace(tzinfo=None)] * 2 + [None],
+                         [v.tzawaredate_utcmicros for v in values])
+
+    def test_roundtrip(self):
+        """Round-trip through the ORM and query by UTC instant"""
+        mapper(InfoMatic, self.table_infomatic, properties={
+            'tzawaredate': tzaware_datetime.helper.get_mapper_definition(
+                self.table_infomatic, 'tzawaredate', storage='epoch')
+        })
+        self.db_metadata.create_all(self.db_myengine)
+        session = create_session(bind=self.db_myengine, autocommit=True, autoflush=True)
+        for info, realdate in self.dates.items():
+            session.add(InfoMatic(info, tzaware_datetime.EpochTZAwareDateTime(realdate=realdate)))
+        session.add(InfoMatic(u'empty', tzaware_datetime.EpochTZAwareDateTime()))
+        session.flush()
+        session.expunge_all()
+
+        ordered = session.query(InfoMatic).filter(InfoMatic.tzawaredate != None).\
+                          order_by(InfoMatic.tzawaredate).all()
+        self.assertEqual([u'Rome', u'London', u'Toronto'], [i.info for i in ordered])
+        for infomatic in ordered:
+            self.assertEqual(self.dates[infomatic.info], infomatic.tzawaredate.realdate)
+            self.assertEqual(None, infomatic.tzawaredate.tzname)
+        self.assertEqual([u'Toronto'],
+                         [i.info for i in session.query(InfoMatic).\
+                              filter(InfoMatic.tzawaredate > self.dates[u'London'])])
+        empty = session.query(InfoMatic).filter(InfoMatic.tzawaredate == None).one()
+        self.assertEqual(None, empty.tzawaredate.realdate)
+        session.close()
+
+    def test_core_helpers(self):
+        """bulk, stream, ingest and partitions write and read the epoch columns"""
+        self.db_metadata.create_all(self.db_myengine)
+        ordered = [self.dates[info] for info in (u'Rome', u'London', u'Toronto')]
+        self.assertEqual(3, tzaware_datetime.bulk.insert(
+            self.db_myengine, self.table_infomatic, 'tzawaredate',
+            [{'info': u'bulk', 'tzawaredate': d} for d in ordered]))
+        self.assertEqual(1, tzaware_datetime.ingest.insert(
+            self.db_myengine, self.table_infomatic, 'tzawaredate',
+            ['2010-01-20T06:00:00.123456+09:00']))
+        tzaware_datetime.bulk.update(self.db_myengine, self.table_infomatic, 'tzawaredate',
+                                     [{'id': 3, 'tzawaredate': None}])
+        raw = self.db_myengine.execute('SELECT tzawaredate_utcmicros, tzawaredate_tzoffset '
+                                       'FROM infomatic ORDER BY id').fetchall()
+        self.assertEqual([(1263963600123456, -3600), (1263967200123456, 0), (None, None),
+                          (1263934800123456, -32400)], raw)
+
+        values = list(tzaware_datetime.stream.select(
+            self.db_myengine, self.table_infomatic, 'tzawaredate', ['id'],
+            order_by=self.table_infomatic.c.id, chunksize=2))
+        self.assertEqual([1, 2, 3, 4], [v[1] for v in values])
+        self.assertTrue(all(isinstance(v[0], tzaware_datetime.EpochTZAwareDateTime)
+                            for v in values))
+        self.assertEqual(ordered[:2], [v[0].realdate for v in values[:2]])
+        self.assertEqual(None, values[2][0].realdate)
+        self.assertEqual(datetime.datetime(2010, 1, 20, 6, 0, 0, 123456,
+                                           tzinfo=dateutil.tz.tzoffset(None, 32400)),
+                         values[3][0].realdate)
+
+        partitioned = tzaware_datetime.TimePartitionedTable(MetaData(), 'events', 'tzawaredate',
+                                                            storage='epoch')
+        self.assertEqual(4, partitioned.insert(self.db_myengine, ordered + [
+            datetime.datetime(2010, 2, 1, tzinfo=dateutil.tz.tzutc())]))
+        self.assertEqual(['events_201001', 'events_201002'],
+                         [t.name for key, t in partitioned.partitions()])
+        self.assertEqual(ordered, list(partitioned.stream(
+            self.db_myengine, end=datetime.datetime(2010, 2, 1, tzinfo=dateutil.tz.tzutc()),
+            realdate=True)))
+
+        table_none = Table('nodates', self.db_metadata, Column('id', Integer, primary_key=True))
+        self.assertRaises(ValueError, tzaware_datetime.bulk.insert, self.db_myengine,
+                          table_none, 'tzawaredate', ordered)
+        self.assertRaises(ValueError, list, tzaware_datetime.stream.select(
+            self.db_myengine, table_none, 'tzawaredate'))
+
+    def test_migrate(self):
+        """Copy rows from the three-column layout and back"""
+        table_old = Table('infomatic_old', self.db_metadata,
+                          Column('id', Integer, primary_key=True),
+                          Column('info', Unicode(255)))
+        tzaware_datetime.helper.append_columns(table_old, 'tzawaredate')
+        table_back = Table('infomatic_back', self.db_metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('info', Unicode(255)))
+        tzaware_datetime.helper.append_columns(table_back, 'tzawaredate')
+        self.db_metadata.create_all(self.db_myengine)
+        rows = [{'info': info, 'tzawaredate': realdate} for info, realdate in self.dates.items()]
+        rows.append({'info': u'empty', 'tzawaredate': None})
+        tzaware_datetime.bulk.insert(self.db_myengine, table_old, 'tzawaredate', rows)
+
+        connection = self.db_myengine.connect()
+        transaction = connection.begin()
+        self.assertEqual(4, tzaware_datetime.helper.migrate_storage(
+            connection, table_old, self.table_infomatic, 'tzawaredate',
+            columns=['id', 'info'], chunksize=3))
+        self.assertEqual(4, tzaware_datetime.helper.migrate_storage(
+            connection, self.table_infomatic, table_back, 'tzawaredate', columns=['id', 'info'],
+            source_storage='epoch', target_storage='datetime'))
+        transaction.commit()
+
+        def stored(table, storage):
+            composite_class = tzaware_datetime._storage_layout(storage)[0]
+            return sorted((info, composite_class(*values).realdate) for info, values in
+                          [(row[0], tuple(row)[1:]) for row in connection.execute(
+                              select([table.c.info] +
+                                     [c for c in table.c if c.key.startswith('tzawaredate_')]))])
+        expected = sorted(self.dates.items()) + [(u'empty', None)]
+        self.assertEqual(expected, stored(self.table_infomatic, 'epoch'))
+        self.assertEqual(expected, stored(table_back, 'datetime'))
+        connection.close()
+
+class TestZoneNames(unittest.TestCase):
+    """timezone names stored as ids in a shared lookup table"""
+    def setUp(self):
+        self.db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        self.db_metadata = MetaData()
+        self.zones = tzaware_datetime.ZoneNameRegistry(self.db_metadata, bind=self.db_myengine)
+        self.table_infomatic = Table('infomatic', self.db_metadata,
+                                     Column('id', Integer, primary_key=True),
+                                     Column('info', Unicode(255)))
+        tzaware_datetime.helper.append_columns(self.table_infomatic, 'tzawaredate',
+                                               zones=self.zones)
+        self.db_metadata.create_all(self.db_myengine)
+        self.dates = [datetime.datetime(2010, 1, 20, 6, tzinfo=dateutil.tz.gettz(zone))
+                      for zone in ('Europe/Rome', 'America/Toronto', 'Europe/Paris',
+                                   'America/New_York', 'UTC')]
+
+    def tearDown(self):
+        clear_mappers()
+
+    def test_columns(self):
+        """The name column is replaced by an integer id column with the same key"""
+        column_tzname = self.table_infomatic.c.tzawaredate_tzname
+        self.assertEqual('tzawaredate_tzid', column_tzname.name)
+        self.assertTrue(isinstance(column_tzname.type, tzaware_datetime.ZoneId))
+        self.assertRaises(ValueError, tzaware_datetime.helper.append_columns,
+                          self.table_infomatic, 'otherdate', storage='epoch', zones=self.zones)
+
+    def test_roundtrip(self):
+        """Names round-trip through the ORM and bulk paths; each is stored once"""
+        mapper(InfoMatic, self.table_infomatic, properties={
+            'tzawaredate': tzaware_datetime.helper.get_mapper_definition(self.table_infomatic,
+                                                                         'tzawaredate')
+        })
+        session = create_session(bind=self.db_myengine, autocommit=True, autoflush=True)
+        session.add_all([InfoMatic(u'orm', tzaware_datetime.TZAwareDateTime(realdate=d))
+                         for d in self.dates])
+        session.add(InfoMatic(u'empty', tzaware_datetime.TZAwareDateTime()))
+        session.flush()
+        tzaware_datetime.bulk.insert(self.db_myengine, self.table_infomatic, 'tzawaredate',
+                                     [{'info': u'bulk', 'tzawaredate': d} for d in self.dates])
+        session.expunge_all()
+
+        expected = [d.tzname() for d in self.dates]
+        infomatics = session.query(InfoMatic).order_by(InfoMatic.id).all()
+        self.assertEqual(expected + [None] + expected,
+                         [i.tzawaredate.tzname for i in infomatics])
+        names = [row.name for row in self.db_myengine.execute(self.zones.table.select())]
+        self.assertEqual(sorted(set(expected)), sorted(names))
+        ids = [row[0] for row in self.db_myengine.execute(
+            'SELECT tzawaredate_tzid FROM infomatic ORDER BY id')]
+        self.assertTrue(all(isinstance(i, int) for i in ids if i is not None), ids)
+        session.close()
+
+    def test_shared_table(self):
+        """Another process resolves ids from the table, and reuses existing names"""
+        cetid = self.zones.id_for(u'CET')
+        self.assertEqual(cetid, self.zones.id_for(u'CET'))
+
+        other = tzaware_datetime.ZoneNameRegistry(MetaData(), bind=self.db_myengine)
+        self.assertEqual(u'CET', other.name_for(cetid))
+        # not cached yet: the insert fails and the existing id is used
+        another = tzaware_datetime.ZoneNameRegistry(MetaData(), bind=self.db_myengine)
+        self.assertEqual(cetid, another.id_for(u'CET'))
+        self.assertEqual(cetid, tzaware_datetime.ZoneNameRegistry(MetaData(),
+                                                                  bind=self.db_myengine).\
+                                    id_for(u'CET'))
+        self.assertNotEqual(cetid, another.id_for(u'EST'))
+        self.assertEqual(u'EST', self.zones.name_for(another.id_for(u'EST')))
+        self.assertRaises(KeyError, other.name_for, 999)
+
+        loaded = tzaware_datetime.ZoneNameRegistry(MetaData(), bind=self.db_myengine)
+        loaded.load()
+        self.assertEqual({u'CET': cetid, u'EST': another.id_for(u'EST')}, loaded._ids)
+
+    def test_rollback(self):
+        """Names are added inside the writer's transaction and roll back with it"""
+        tempdir = tempfile.mkdtemp()
+        db_myengine = create_engine('sqlite:///%s' % os.path.join(tempdir, 'zones.db'))
+        db_metadata = MetaData()
+        zones = tzaware_datetime.ZoneNameRegistry(db_metadata, bind=db_myengine)
+        table_infomatic = Table('infomatic', db_metadata,
+                                Column('id', Integer, primary_key=True),
+                                Column('info', Unicode(255)))
+        tzaware_datetime.helper.append_columns(table_infomatic, 'tzawaredate', zones=zones)
+        mapper(InfoMatic, table_infomatic, properties={
+            'tzawaredate': tzaware_datetime.helper.get_mapper_definition(table_infomatic,
+                                                                         'tzawaredate')
+        })
+        db_metadata.create_all(db_myengine)
+        def stored(table):
+            return db_myengine.execute(table.select()).fetchall()
+        try:
+            connection = db_myengine.connect()
+            transaction = connection.begin()
+            connection.execute(table_infomatic.insert(), id=1)
+            tzaware_datetime.bulk.insert(connection, table_infomatic, 'tzawaredate',
+                                         [{'id': 2, 'tzawaredate': self.dates[0]}])
+            self.assertEqual([(None,), (u'CET',)], connection.execute(
+                select([table_infomatic.c.tzawaredate_tzname])).fetchall())
+            transaction.rollback()
+            self.assertEqual([], stored(table_infomatic))
+            self.assertEqual([], stored(zones.table))
+            self.assertEqual({}, zones._ids)
+
+            session = create_session(bind=connection, autocommit=False)
+            session.add(InfoMatic(u'orm', tzaware_datetime.TZAwareDateTime(realdate=self.dates[1])))
+            session.flush()
+            session.rollback()
+            self.assertEqual([], stored(table_infomatic))
+            self.assertEqual([], stored(zones.table))
+            session.add(InfoMatic(u'orm', tzaware_datetime.TZAwareDateTime(realdate=self.dates[1])))
+            session.commit()
+            self.assertEqual([u'EST'], [row.name for row in stored(zones.table)])
+            self.assertEqual({}, zones._ids)
+
+            transaction = connection.begin()
+            tzaware_datetime.bulk.insert(connection, table_infomatic, 'tzawaredate',
+                                         [self.dates[0], self.dates[1]])
+            transaction.commit()
+            # EST was found committed; CET is cached once a lookup finds it committed
+            self.assertEqual([u'EST'], list(zones._ids))
+            self.assertEqual([u'EST', u'CET', u'EST'], [
+                zones.name_for(row[0]) for row in connection.execute(
+                    'SELECT tzawaredate_tzid FROM infomatic ORDER BY id')])
+            self.assertEqual([u'CET', u'EST'], sorted(zones._ids))
+            session.close()
+            connection.close()
+        finally:
+            db_myengine.dispose()
+            shutil.rmtree(tempdir)
+
+    def test_comparisons(self):
+        """Comparing against a name looks it up but never adds it"""
+        tzaware_datetime.bulk.insert(self.db_myengine, self.table_infomatic, 'tzawaredate',
+                                     self.dates[:2])
+        column_tzname = self.table_infomatic.c.tzawaredate_tzname
+        def ids(whereclause):
+            return [row[0] for row in self.db_myengine.execute(
+                select([self.table_infomatic.c.id], whereclause).order_by(
+                    self.table_infomatic.c.id))]
+        self.assertEqual([1], ids(column_tzname == u'CET'))
+        self.assertEqual([], ids(column_tzname == u'Nope/Zone'))
+        self.assertEqual([1, 2], ids(column_tzname != u'Nope/Zone'))
+        self.assertEqual([2], ids(column_tzname.in_([u'EST', u'Nope/Zone'])))
+        self.assertEqual([u'CET', u'EST'],
+                         sorted(row.name for row in self.db_myengine.execute(
+                             self.zones.table.select())))
+        # a fresh registry finds names added elsewhere
+        other = tzaware_datetime.ZoneNameRegistry(MetaData(), bind=self.db_myengine)
+        self.assertEqual(self.zones.id_for(u'EST'), other.lookup(u'EST'))
+        self.assertEqual(None, other.lookup(u'Nope/Zone'))
+
+    def test_unregistered_write(self):
+        """Plain Core writes need their names added on the writing connection first"""
+        self.assertRaises(sqlalchemy.exc.InvalidRequestError, self.db_myengine.execute,
+                          self.table_infomatic.insert(), tzawaredate_tzname=u'CET')
+        connection = self.db_myengine.connect()
+        transaction = connection.begin()
+        self.zones.id_for(u'CET', connection)
+        connection.execute(self.table_infomatic.insert(), tzawaredate_tzname=u'CET')
+        transaction.commit()
+        self.assertEqual([(u'CET',)], self.db_myengine.execute(
+            select([self.table_infomatic.c.tzawaredate_tzname])).fetchall())
+        connection.close()
+
+    def test_unbound(self):
+        """An unbound registry cannot add names"""
+        unbound = tzaware_datetime.ZoneNameRegistry(MetaData())
+        self.assertRaises(sqlalchemy.exc.UnboundExecutionError, unbound.id_for, u'CET')
+
+class TestInstrumentation(unittest.TestCase):
+    """opt-in counters and timings"""
+    def setUp(self):
+        self.instrumentation = tzaware_datetime.Instrumentation()
+        self.newdate = datetime.datetime(2010, 1, 15, 8, tzinfo=dateutil.tz.gettz('Europe/Rome'))
+
+    def tearDown(self):
+        self.instrumentation.disable()
+        clear_mappers()
+
+    def test_disabled_by_default(self):
+        """Nothing is counted or wrapped unless enabled"""
+        original = vars(tzaware_datetime._TZAwareDateTimeBase)['_build_realdate']
+        tzaware_datetime.TZAwareDateTime(realdate=self.newdate).realdate
+        self.assertEqual({}, self.instrumentation.stats())
+        self.instrumentation.enable()
+        self.assertFalse(vars(tzaware_datetime._TZAwareDateTimeBase)['_build_realdate']
+                         is original)
+        self.instrumentation.disable()
+        self.assertTrue(vars(tzaware_datetime._TZAwareDateTimeBase)['_build_realdate']
+                        is original)
+
+    def test_counts(self):
+        """Hot paths are counted and timed"""
+        events = []
+        self.instrumentation.enable(callback=lambda event, seconds: events.append(event))
+        tzaware_datetime.tzinfo_registry.clear()
+        value = tzaware_datetime.TZAwareDateTime(realdate=self.newdate)
+        value.realdate
+        value.realdate
+        frozen = tzaware_datetime.FrozenTZAwareDateTime(realdate=self.newdate)
+        frozen.realdate
+        list(tzaware_datetime.bulk.composite_values([self.newdate]))
+        table = Table('infomatic', MetaData(), Column('id', Integer, primary_key=True))
+        tzaware_datetime.helper.append_columns(table, 'tzawaredate')
+        tzaware_datetime.helper.get_mapper_definition(table, 'tzawaredate')
+
+        stats = self.instrumentation.stats()
+        self.assertEqual({'construct': 2, 'set_realdate': 3, 'get_realdate': 2,
+                          'tzinfo_create': 1, 'helper.append_columns': 1,
+                          'helper.get_mapper_definition': 1},
+                         dict((event, stat['count']) for event, stat in stats.items()))
+        self.assertTrue(all(stat['seconds'] >= 0 for stat in stats.values()))
+        self.assertEqual(sorted(events), sorted(sum([[event] * stat['count']
+                                                     for event, stat in stats.items()], [])))
+
+        self.instrumentation.disable()
+        tzaware_datetime.TZAwareDateTime(realdate=self.newdate)
+        self.assertEqual(2, self.instrumentation.stats()['construct']['count'])
+        self.instrumentation.reset()
+        self.assertEqual({}, self.instrumentation.stats())
+
+    def test_enable_twice(self):
+        """Enabling again only replaces the callback"""
+        self.instrumentation.enable()
+        self.instrumentation.enable()
+        tzaware_datetime.TZAwareDateTime(realdate=self.newdate)
+        self.assertEqual(1, self.instrumentation.stats()['construct']['count'])
+        self.instrumentation.disable()
+        self.assertEqual('_build_realdate',
+                         tzaware_datetime._TZAwareDateTimeBase._build_realdate.__name__)
+
+class TestNamedZones(unittest.TestCase):
+    """IANA zone keys stored as tzname and resolved through the registry"""
+    def setUp(self):
+        self.toronto = dateutil.tz.gettz('America/Toronto')
+        self.newdate = datetime.datetime(2010, 3, 13, 12, tzinfo=self.toronto)
+
+    def tearDown(self):
+        clear_mappers()
+
+    def test_zone_key(self):
+        """The zone key is stored and DST applies after arithmetic"""
+        named = tzaware_datetime.NamedZoneTZAwareDateTime(realdate=self.newdate)
+        self.assertEqual(u'America/Toronto', named.tzname)
+        self.assertEqual(self.newdate, named.realdate)
+        self.assertTrue(named.realdate.tzinfo is tzaware_datetime.tzinfo_registry.zone('America/Toronto'))
+        # DST starts 2010-03-14 in Toronto
+        nextday = named.realdate + datetime.timedelta(days=1)
+        self.assertEqual(datetime.timedelta(hours=-4), nextday.utcoffset())
+        plain = tzaware_datetime.TZAwareDateTime(realdate=self.newdate)
+        self.assertEqual(u'EST', plain.tzname)
+        self.assertEqual(named.__composite_values__()[::2], plain.__composite_values__()[::2])
+
+    def test_fallback(self):
+        """Unresolvable or inconsistent names fall back to the stored offset"""
+        utcdt = datetime.datetime(2010, 3, 13, 17)
+        resolved = tzaware_datetime.NamedZoneTZAwareDateTime(utcdt, u'America/Toronto', 18000)
+        self.assertEqual(datetime.datetime(2010, 3, 13, 12), resolved.realdate.replace(tzinfo=None))
+        for tzname in (u'Not/AZone', None, u'Asia/Tokyo'):
+            named = tzaware_datetime.NamedZoneTZAwareDateTime(utcdt, tzname, 18000)
+            self.assertEqual(utcdt.replace(tzinfo=dateutil.tz.tzutc()), named.realdate)
+            self.assertEqual(resolved.realdate.replace(tzinfo=None),
+                             named.realdate.replace(tzinfo=None))
+            self.assertEqual(resolved.realdate.utcoffset(), named.realdate.utcoffset())
+        nozone = tzaware_datetime.NamedZoneTZAwareDateTime(
+            realdate=datetime.datetime(2010, 3, 13, 12, tzinfo=dateutil.tz.tzoffset(None, 3600)))
+        self.assertEqual(None, nozone.tzname)
+
+    def test_ambiguous_hour(self):
+        """Both instants of a repeated wall-clock hour keep their own offset"""
+        for utcdt in (datetime.datetime(2010, 11, 7, 5, 30), datetime.datetime(2010, 11, 7, 6, 30)):
+            realdate = utcdt.replace(tzinfo=dateutil.tz.tzutc()).astimezone(self.toronto)
+            named = tzaware_datetime.NamedZoneTZAwareDateTime(realdate=realdate)
+            fromdb = tzaware_datetime.NamedZoneTZAwareDateTime(*named.__composite_values__())
+            self.assertEqual(realdate, fromdb.realdate)
+            self.assertEqual(realdate.utcoffset(), fromdb.realdate.utcoffset())
+
+    def test_zone_days(self):
+        """Cached zone days rebuild the same realdate across DST changes"""
+        registry = tzaware_datetime.tzinfo_registry
+        registry.clear()
+        utc = dateutil.tz.tzutc()
+        zone = registry.zone('America/Toronto')
+        # hourly around both changes (2010-03-14, 2010-11-07), daily in between
+        for hours in range(0, 24 * 240):
+            if hours % 24 and not (24 <= hours < 72 or 5712 <= hours < 5760):
+                continue
+            utcdt = datetime.datetime(2010, 3, 13, 0, 30) + datetime.timedelta(hours=hours)
+            realdate = utcdt.replace(tzinfo=utc).astimezone(self.toronto)
+            offsetseconds = tzaware_datetime._offset_seconds(realdate.utcoffset())
+            for value in (tzaware_datetime.NamedZoneTZAwareDateTime(utcdt, u'America/Toronto',
+                                                                    offsetseconds),
+                          tzaware_datetime.NamedZoneTZAwareDateTime(realdate=realdate)):
+                self.assertEqual(realdate, value.realdate)
+                self.assertEqual(realdate.utcoffset(), value.realdate.utcoffset())
+                self.assertTrue(value.realdate.tzinfo is zone)
+        def day(offsetseconds, *ymd):
+            return registry.zone_days[u'America/Toronto', offsetseconds,
+                                      datetime.date(*ymd).toordinal()]
+        self.assertEqual((zone, datetime.timedelta(hours=5)), day(18000, 2010, 3, 13))
+        self.assertEqual((zone, datetime.timedelta(hours=4)), day(14400, 2010, 3, 15))
+        # the UTC days holding a change are checked per value
+        self.assertEqual(None, day(18000, 2010, 3, 14))
+        self.assertEqual(None, day(14400, 2010, 3, 14))
+        self.assertEqual(None, day(14400, 2010, 11, 7))
+        self.assertEqual(None, registry.zone_day(u'Asia/Tokyo', 18000,
+                                                 datetime.date(2010, 3, 13).toordinal()))
+        registry.clear()
+        self.assertEqual({}, registry.zone_days)
+
+    def test_zone_key_sources(self):
+        """Keys are found on dateutil, pytz-style and zoneinfo-style tzinfos"""
+        class Keyed(object):
+            key = 'Europe/Rome'
+        class Zoned(object):
+            zone = 'Europe/Paris'
+        class Packaged(object):
+            _filename = 'Asia/Tokyo'
+        self.assertEqual('America/Toronto', tzaware_datetime._zone_key(self.toronto))
+        self.assertEqual('Europe/Rome', tzaware_datetime._zone_key(Keyed()))
+        self.assertEqual('Europe/Paris', tzaware_datetime._zone_key(Zoned()))
+        self.assertEqual('Asia/Tokyo', tzaware_datetime._zone_key(Packaged()))
+        self.assertEqual(None, tzaware_datetime._zone_key(dateutil.tz.tzutc()))
+
+    def test_database_prewarm(self):
+        """Names round-trip through the database and prewarm the registry"""
+        db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        db_metadata = MetaData()
+        table_infomatic = Table('infomatic', db_metadata,
+                                Column('id', Integer, primary_key=True),
+                                Column('info', Unicode(255)))
+        tzaware_datetime.helper.append_columns(table_infomatic, 'tzawaredate')
+        mapper(InfoMatic, table_infomatic, properties={
+            'tzawaredate': tzaware_datetime.helper.get_mapper_definition(
+                table_infomatic, 'tzawaredate',
+                composite_class=tzaware_datetime.NamedZoneTZAwareDateTime)
+        })
+        db_metadata.create_all(db_myengine)
+        session = create_session(bind=db_myengine, autocommit=True, autoflush=True)
+        session.add(InfoMatic(u'Toronto',
+                              tzaware_datetime.NamedZoneTZAwareDateTime(realdate=self.newdate)))
+        session.add(InfoMatic(u'offset', tzaware_datetime.NamedZoneTZAwareDateTime(
+            realdate=datetime.datetime(2010, 1, 1, tzinfo=dateutil.tz.gettz('Europe/Rome')))))
+        session.add(InfoMatic(u'empty', tzaware_datetime.NamedZoneTZAwareDateTime()))
+        session.flush()
+        session.expunge_all()
+
+        tzaware_datetime.tzinfo_registry.clear()
+        self.assertEqual([u'America/Toronto', u'Europe/Rome'], sorted(
+            tzaware_datetime.helper.prewarm_zones(db_myengine, table_infomatic, 'tzawaredate')))
+        self.assertEqual(2, tzaware_datetime.tzinfo_registry.stats()['misses'])
+        fromdb = session.query(InfoMatic).filter_by(info=u'Toronto').one().tzawaredate
+        self.assertTrue(isinstance(fromdb, tzaware_datetime.NamedZoneTZAwareDateTime))
+        self.assertEqual(self.newdate, fromdb.realdate)
+        self.assertEqual(self.toronto.utcoffset(self.newdate.replace(tzinfo=None) +
+                                                datetime.timedelta(days=1)),
+                         (fromdb.realdate + datetime.timedelta(days=1)).utcoffset())
+        self.assertEqual(2, tzaware_datetime.tzinfo_registry.stats()['misses'])
+        session.close()
+
+class TestIngest(unittest.TestCase):
+    """ISO-8601 timestamp strings parsed into storage triples"""
+    def setUp(self):
+        self.timestamps = ['2010-01-20T06:00:00+01:00', '2010-01-20 06:00:00.25-0500',
+                           '2010-01-20T06:00:00.123456789+09:00', '2010-01-20T06:00:00Z',
+                           '2010-01-20T06:00:00+10:30']
+
+    def test_fast_path(self):
+        """The fixed-format parser matches the stored composite values"""
+        zero_offsets = ['2010-01-20T06:00:00+00:00', '2010-01-20T06:00:00-00:00',
+                        '2010-01-20 06:00:00+0000']
+        for timestamp in self.timestamps + zero_offsets:
+            realdate = dateutil.parser.parse(timestamp)
+            utcdt, tzname, offsetseconds = tzaware_datetime.ingest.parse(timestamp)
+            self.assertEqual(realdate.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None), utcdt)
+            self.assertEqual(-realdate.utcoffset(), datetime.timedelta(seconds=offsetseconds))
+            self.assertEqual(tzaware_datetime.TZAwareDateTime(realdate=realdate).tzname, tzname)
+        self.assertEqual((datetime.datetime(2010, 1, 20, 5), None, -3600),
+                         tzaware_datetime.ingest.parse('2010-01-20T06:00:00+01:00'))
+        self.assertEqual((datetime.datetime(2010, 1, 20, 6), u'UTC', 0),
+                         tzaware_datetime.ingest.parse(' 2010-01-20T06:00:00Z\n'))
+
+    def test_fallback(self):
+        """Other formats go through dateutil; naive timestamps are rejected"""
+        self.assertEqual((datetime.datetime(2010, 1, 20, 11), u'EST', 18000),
+                         tzaware_datetime.ingest.parse('Wed, 20 Jan 2010 06:00:00 -0500 (EST)'))
+        self.assertRaises(ValueError, tzaware_datetime.ingest.parse, '2010-01-20T06:00:00')
+
+    def test_parallel_order(self):
+        """Worker processes return triples in input order"""
+        timestamps = ['2010-01-%02dT%02d:00:00+0%d:00' % (day, hour, hour % 10)
+                      for day in range(1, 29) for hour in range(24)]
+        expected = [tzaware_datetime.ingest.parse(t) for t in timestamps]
+        self.assertEqual(expected, list(tzaware_datetime.ingest.triples(timestamps, processes=1,
+                                                                          chunksize=7)))
+        self.assertEqual(expected, list(tzaware_datetime.ingest.triples(iter(timestamps),
+                                                                          processes=2,
+                                                                          chunksize=7)))
+
+    def test_insert_file(self):
+        """Lines of a file are inserted as rows"""
+        handle, path = tempfile.mkstemp()
+        try:
+            os.write(handle, '\n'.join(self.timestamps) + '\n\n')
+            os.close(handle)
+            db_myengine = create_engine('sqlite:///:memory:', echo=False)
+            db_metadata = MetaData()
+            table_infomatic = Table('infomatic', db_metadata,
+                                    Column('id', Integer, primary_key=True))
+            tzaware_datetime.helper.append_columns(table_infomatic, 'tzawaredate')
+            db_metadata.create_all(db_myengine)
+            with open(path) as timestamps:
+                count = tzaware_datetime.ingest.insert(db_myengine, table_infomatic, 'tzawaredate',
+                                                       timestamps, processes=2, chunksize=2)
+            self.assertEqual(5, count)
+            rows = db_myengine.execute(select([table_infomatic.c.tzawaredate_utcdate,
+                                               table_infomatic.c.tzawaredate_tzname,
+                                               table_infomatic.c.tzawaredate_tzoffset],
+                                              order_by=[table_infomatic.c.id])).fetchall()
+            self.assertEqual([tzaware_datetime.ingest.parse(t) for t in self.timestamps],
+                             [tuple(row) for row in rows])
+        finally:
+            os.remove(path)
+
+class TestSerialization(unittest.TestCase):
+    """Pickling and packed encoding keep the stored values, not tzinfo objects"""
+    def setUp(self):
+        self.dates = [datetime.datetime(2010, 1, 20, 6, 30, 15, 250, tzinfo=dateutil.tz.gettz(zone))
+                      for zone in ('Europe/Rome', 'America/Toronto', 'Asia/Tokyo', 'UTC')]
+        self.dates.append(datetime.datetime(1900, 1, 1, tzinfo=dateutil.tz.tzoffset(None, 19800)))
+
+    def assertSameValues(self, expected, actual):
+        self.assertEqual([type(v) for v in expected], [type(v) for v in actual])
+        self.assertEqual([v.__composite_values__() for v in expected],
+                         [v.__composite_values__() for v in actual])
+        self.assertEqual([v.realdate for v in expected], [v.realdate for v in actual])
+
+    def test_pickle(self):
+        """Every variant round-trips through every pickle protocol"""
+        values = [cls(realdate=d) for d in self.dates
+                  for cls in (tzaware_datetime.TZAwareDateTime,
+                              tzaware_datetime.SlottedTZAwareDateTime,
+                              tzaware_datetime.FrozenTZAwareDateTime,
+                              tzaware_datetime.NamedZoneTZAwareDateTime,
+                              tzaware_datetime.EpochTZAwareDateTime)]
+        # as loaded from the database: naive UTC, and empty
+        values.append(tzaware_datetime.TZAwareDateTime(datetime.datetime(2010, 1, 20, 5), u'CET', -3600))
+        values.append(tzaware_datetime.TZAwareDateTime())
+        for value in values:
+            value.realdate
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertSameValues(values, pickle.loads(pickle.dumps(values, protocol)))
+
+    def test_pickle_legacy(self):
+        """Values pickled as a plain __dict__ (before __reduce__) still load"""
+        payloads = [
+            # protocol 0
+            "ccopy_reg\n_reconstructor\np0\n(ctzaware_datetime\nTZAwareDateTime\np1\n"
+            "c__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\nS'utcdt'\np6\ncdatetime\ndatetime\np7\n"
+            "(S'\\x07\\xda\\x03\\r\\x05\\x1e\\x00\\x00\\x00\\x00'\np8\ntp9\nRp10\n"
+            "sS'tzname'\np11\nVEST\np12\nsS'offsetseconds'\np13\nI18000\nsb.",
+            # protocol 2
+            "\x80\x02ctzaware_datetime\nTZAwareDateTime\nq\x00)\x81q\x01}q\x02(U\x05utcdtq\x03"
+            "cdatetime\ndatetime\nq\x04U\n\x07\xda\x03\r\x05\x1e\x00\x00\x00\x00q\x05\x85q\x06Rq\x07"
+            "U\x06tznameq\x08X\x03\x00\x00\x00ESTq\tU\roffsetsecondsq\nMPFub.",
+        ]
+        expected = tzaware_datetime.TZAwareDateTime(datetime.datetime(2010, 3, 13, 5, 30), u'EST', 18000)
+        for payload in payloads:
+            value = pickle.loads(payload)
+            self.assertEqual((datetime.datetime(2010, 3, 13, 5, 30), u'EST', 18000),
+                             (value._utcdt, value._tzname, value._offsetseconds))
+            self.assertTrue(value._realdate is tzaware_datetime._REALDATE_UNSET)
+            self.assertEqual(expected.realdate, value.realdate)
+            self.assertEqual(expected.realdate.utcoffset(), value.realdate.utcoffset())
+
+    def test_pickle_size(self):
+        """The cached realdate and its tzinfo are not pickled"""
+        value = tzaware_datetime.TZAwareDateTime(realdate=self.dates[1])
+        before = len(pickle.dumps(value, 2))
+        value.realdate
+        self.assertEqual(before, len(pickle.dumps(value, 2)))
+        self.assertFalse('tzfile' in pickle.dumps(value, 2))
+
+    def test_packed(self):
+        """Lists of values round-trip through packed.encode/decode"""
+        values = [tzaware_datetime.TZAwareDateTime(realdate=d) for d in self.dates * 3]
+        values.append(tzaware_datetime.TZAwareDateTime(datetime.datetime(2010, 1, 20, 5), u'CET', -3600))
+        values.append(tzaware_datetime.TZAwareDateTime())
+        buffer = tzaware_datetime.packed.encode(values)
+        self.assertSameValues(values, tzaware_datetime.packed.decode(buffer))
+        frozen = tzaware_datetime.packed.decode(
+            buffer, composite_class=tzaware_datetime.FrozenTZAwareDateTime)
+        self.assertEqual(values, frozen)
+        self.assertSameValues([], tzaware_datetime.packed.decode(tzaware_datetime.packed.encode([])))
+        self.assertRaises(ValueError, tzaware_datetime.packed.decode, 'XXXX' + buffer[4:])
+
+class UpdateRecorder(ConnectionProxy):
+    """collects the bound parameter names of each UPDATE an engine executes"""
+    def __init__(self):
+        self.updates = []
+
+    def execute(self, conn, execute, clauseelement, *multiparams, **params):
+        if str(clauseelement).startswith('UPDATE'):
+            rows = multiparams[0]
+            if isinstance(rows, dict):
+                rows = [rows]
+            self.updates.extend(sorted(row) for row in rows)
+        return execute(clauseelement, *multiparams, **params)
+
+class TestChangeTracking(unittest.TestCase):
+    """In-place changes to loaded values are flushed; unchanged values are not"""
+    def setUp(self):
+        self.recorder = UpdateRecorder()
+        self.db_myengine = create_engine('sqlite:///:memory:', echo=False, proxy=self.recorder)
+        self.db_metadata = MetaData()
+        self.table_infomatic = Table('infomatic', self.db_metadata,
+                                     Column('id', Integer, primary_key=True),
+                                     Column('info', Unicode(255)))
+        tzaware_datetime.helper.append_columns(self.table_infomatic, 'tzawaredate')
+        mapper(InfoMatic, self.table_infomatic, properties={
+            'tzawaredate': tzaware_datetime.helper.get_mapper_definition(self.table_infomatic,
+                                                                         'tzawaredate')
+        })
+        self.db_metadata.create_all(self.db_myengine)
+        self.session = create_session(bind=self.db_myengine, autocommit=True, autoflush=True)
+        self.rome = datetime.datetime(2010, 1, 20, 6, tzinfo=dateutil.tz.gettz('Europe/Rome'))
+        self.tokyo = datetime.datetime(2010, 1, 20, 6, tzinfo=dateutil.tz.gettz('Asia/Tokyo'))
+        self.session.add(InfoMatic(u'Rome', tzaware_datetime.TZAwareDateTime(realdate=self.rome)))
+        self.session.flush()
+        self.session.expunge_all()
+
+    def tearDown(self):
+        self.session.close()
+        clear_mappers()
+
+    def flush_change(self, change):
+        """apply change to the loaded row and flush
+
+        returns (modified before flush, UPDATE statements, value read back)"""
+        infomatic = self.session.query(InfoMatic).one()
+        change(infomatic)
+        modified = self.session.is_modified(infomatic)
+        self.recorder.updates = []
+        self.session.flush()
+        self.session.expunge_all()
+        return (modified, self.recorder.updates,
+                self.session.query(InfoMatic).one().tzawaredate)
+
+    def test_realdate_setter(self):
+        """Setting .realdate marks the row dirty and stores the new value"""
+        def change(infomatic):
+            infomatic.tzawaredate.realdate = self.tokyo
+        modified, updates, stored = self.flush_change(change)
+        self.assertTrue(modified)
+        self.assertEqual([['infomatic_id', 'tzawaredate_tzname', 'tzawaredate_tzoffset',
+                           'tzawaredate_utcdate']], updates)
+        self.assertEqual(self.tokyo, stored.realdate)
+        self.assertEqual(u'JST', stored.tzname)
+
+    def test_composite_values(self):
+        """__set_composite_values__ and attribute assignment mark the row dirty"""
+        tokyo = tzaware_datetime.TZAwareDateTime(realdate=self.tokyo).__composite_values__()
+        def change(infomatic):
+            infomatic.tzawaredate.__set_composite_values__(*tokyo)
+        modified, updates, stored = self.flush_change(change)
+        self.assertTrue(modified)
+        self.assertEqual(self.tokyo, stored.realdate)
+        def change(infomatic):
+            infomatic.tzawaredate.offsetseconds = -3600
+        modified, updates, stored = self.flush_change(change)
+        self.assertTrue(modified)
+        self.assertEqual(-3600, stored.offsetseconds)
+
+    def test_unchanged(self):
+        """Re-setting the same values, aware or naive, issues no UPDATE"""
+        def change(infomatic):
+            infomatic.tzawaredate.realdate = self.rome.astimezone(dateutil.tz.gettz('Europe/Paris'))
+            infomatic.tzawaredate.tzname = u'CET'
+        self.assertEqual((False, []), self.flush_change(change)[:2])
+        self.assertEqual((False, []), self.flush_change(lambda infomatic: None)[:2])
+        def change(infomatic):
+            infomatic.info = u'Roma'
+        modified, updates, stored = self.flush_change(change)
+        self.assertTrue(modified)
+        self.assertEqual([['info', 'infomatic_id']], updates)
+        self.assertEqual(self.rome, stored.realdate)
+
+    def test_compare_values(self):
+        """UTC column types compare naive and aware values by instant"""
+        naive = datetime.datetime(2010, 1, 20, 5)
+        aware = naive.replace(tzinfo=dateutil.tz.tzutc())
+        for coltype in (tzaware_datetime.UTCDateTime(), tzaware_datetime.UTCMicroseconds()):
+            self.assertTrue(coltype.compare_values(naive, aware))
+            self.assertTrue(coltype.compare_values(aware.astimezone(dateutil.tz.tzoffset(None, 3600)),
+                                                   naive))
+            self.assertFalse(coltype.compare_values(naive, None))
+            self.assertTrue(coltype.compare_values(None, None))
+
+class TestLocalTime(unittest.TestCase):
+    """Local date/time bucketing computed in SQL from the UTC and offset columns"""
+    def setUp(self):
+        zones = [dateutil.tz.gettz(zone) for zone in ('Europe/Rome', 'America/Toronto',
+                                                      'Asia/Tokyo', 'Asia/Kolkata')]
+        start = datetime.datetime(2010, 3, 13, 22, 59, 59, 999999, tzinfo=dateutil.tz.tzutc())
+        # across midnight and the Toronto DST change, in every zone
+        self.dates = [(start + datetime.timedelta(minutes=37 * n)).astimezone(zones[n % len(zones)])
+                      for n in range(200)]
+        self.dates.append(datetime.datetime(1969, 12, 31, 23, 59, 59, 500000,
+                                            tzinfo=dateutil.tz.tzutc()))
+
+    def tearDown(self):
+        clear_mappers()
+
+    def session_for(self, storage):
+        db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        db_metadata = MetaData()
+        table_infomatic = Table('infomatic', db_metadata,
+                                Column('id', Integer, primary_key=True),
+                                Column('info', Unicode(255)))
+        tzaware_datetime.helper.append_columns(table_infomatic, 'tzawaredate', storage=storage)
+        mapper(InfoMatic, table_infomatic, properties={
+            'tzawaredate': tzaware_datetime.helper.get_mapper_definition(table_infomatic,
+                                                                         'tzawaredate',
+                                                                         storage=storage)
+        })
+        db_metadata.create_all(db_myengine)
+        session = create_session(bind=db_myengine)
+        composite_class = tzaware_datetime._storage_layout(storage)[0]
+        session.add_all([InfoMatic(u'', composite_class(realdate=d)) for d in self.dates])
+        session.flush()
+        return table_infomatic, session
+
+    def counts(self, keys):
+        counts = {}
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+        return sorted(counts.items())
+
+    def test_buckets(self):
+        """GROUP BY local date/hour matches bucketing the original datetimes"""
+        for storage in ('datetime', 'epoch'):
+            table_infomatic, session = self.session_for(storage)
+            local = InfoMatic.tzawaredate.local_datetime()
+            self.assertEqual([d.replace(tzinfo=None) for d in self.dates],
+                             [row[0] for row in session.query(local).order_by(InfoMatic.id)])
+            for bucket, key in ((InfoMatic.tzawaredate.local_date(), lambda d: d.date()),
+                                (InfoMatic.tzawaredate.local_hour(),
+                                 lambda d: d.replace(minute=0, second=0, microsecond=0,
+                                                     tzinfo=None))):
+                self.assertEqual(self.counts(key(d) for d in self.dates),
+                                 session.query(bucket, func.count(InfoMatic.id)).group_by(bucket)
+                                 .order_by(bucket).all())
+            session.close()
+            clear_mappers()
+
+    def test_core(self):
+        """Table columns can be used directly; a NULL offset is UTC"""
+        table_infomatic, session = self.session_for('datetime')
+        db_myengine = session.bind
+        db_myengine.execute(table_infomatic.insert(),
+                            tzawaredate_utcdate=datetime.datetime(2010, 1, 1, 23, 30))
+        bucket = tzaware_datetime.local_date(table_infomatic.c.tzawaredate_utcdate,
+                                             table_infomatic.c.tzawaredate_tzoffset).label('day')
+        self.assertEqual(datetime.date(2010, 1, 1), db_myengine.execute(
+            select([bucket], table_infomatic.c.tzawaredate_tzoffset == None)).scalar())
+        session.close()
+
+    def test_dialects(self):
+        """PostgreSQL uses interval arithmetic; other dialects refuse to compile"""
+        from sqlalchemy.dialects import postgresql, mysql
+        table_infomatic, session = self.session_for('datetime')
+        self.assertEqual("date_trunc('hour', (infomatic.tzawaredate_utcdate - "
+                         "COALESCE(infomatic.tzawaredate_tzoffset, 0) * INTERVAL '1 second'))",
+                         str(InfoMatic.tzawaredate.local_hour().compile(
+                             dialect=postgresql.dialect())))
+        self.assertRaises(sqlalchemy.exc.CompileError,
+                          InfoMatic.tzawaredate.local_date().compile, dialect=mysql.dialect())
+        session.close()
+
+class TestTimePartitions(unittest.TestCase):
+    """Per-period tables routed and read by UTC instant"""
+    def setUp(self):
+        self.db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        self.columns = (Column('id', Integer, primary_key=True), Column('info', Unicode(255)))
+        self.partitioned = tzaware_datetime.TimePartitionedTable(MetaData(), 'events', 'tzawaredate',
+                                                                 self.columns, index=True)
+        rome = dateutil.tz.gettz('Europe/Rome')
+        # the first is 2009-12-31 23:30 UTC
+        self.dates = [datetime.datetime(2010, 1, 1, 0, 30, tzinfo=rome) + datetime.timedelta(days=10 * n)
+                      for n in range(10)]
+
+    def test_routing(self):
+        """Rows land in the partition of their UTC instant"""
+        rows = [{'tzawaredate': d, 'info': unicode(n)} for n, d in enumerate(self.dates)]
+        self.assertEqual(10, self.partitioned.insert(self.db_myengine, rows, chunksize=2))
+        self.assertEqual(['events_200912', 'events_201001', 'events_201002', 'events_201003'],
+                         [t.name for key, t in self.partitioned.partitions()])
+        for key, partition in self.partitioned.partitions():
+            for utcdate, in self.db_myengine.execute(select([partition.c.tzawaredate_utcdate])):
+                self.assertEqual(key, self.partitioned.period_start(
+                    utcdate.replace(tzinfo=dateutil.tz.tzutc())))
+        self.assertTrue(self.partitioned.partitions()[0][1].indexes)
+        self.assertRaises(ValueError, self.partitioned.insert, self.db_myengine, [None])
+
+    def test_range(self):
+        """Range reads use only overlapping partitions and come back in UTC order"""
+        self.partitioned.insert(self.db_myengine, reversed(self.dates))
+        statement = self.partitioned.select(self.dates[2], self.dates[6])
+        # dates[6] is 2010-03-01 23:30 UTC
+        self.assertEqual(['events_201001', 'events_201002', 'events_201003'],
+                         sorted(t.name for part in statement.selects for t in part.froms))
+        rows = self.db_myengine.execute(statement.order_by('tzawaredate_utcdate')).fetchall()
+        self.assertEqual([tzaware_datetime.TZAwareDateTime(realdate=d).utcdt.replace(tzinfo=None)
+                          for d in self.dates[2:6]],
+                         [row['tzawaredate_utcdate'] for row in rows])
+        self.assertEqual(self.dates[2:6], list(self.partitioned.stream(
+            self.db_myengine, self.dates[2], self.dates[6], chunksize=1, realdate=True)))
+        self.assertEqual(self.dates, [v.realdate for v in self.partitioned.stream(self.db_myengine)])
+        self.assertEqual([(self.dates[0], None)], list(self.partitioned.stream(
+            self.db_myengine, end=self.dates[1], columns=('info',), realdate=True)))
+        self.assertEqual(None, self.partitioned.select(datetime.datetime(2011, 1, 1,
+                                                                        tzinfo=dateutil.tz.tzutc())))
+
+    def test_load(self):
+        """A new instance finds existing partitions; daily periods name tables by day"""
+        start = datetime.datetime(2010, 2, 27, tzinfo=dateutil.tz.tzutc())
+        self.partitioned.create(self.db_myengine, start, start + datetime.timedelta(days=40))
+        daily = tzaware_datetime.TimePartitionedTable(MetaData(), 'events', 'tzawaredate',
+                                                      self.columns, period='day')
+        daily.create(self.db_myengine, start, start + datetime.timedelta(days=3))
+        reloaded = tzaware_datetime.TimePartitionedTable(MetaData(), 'events', 'tzawaredate',
+                                                         self.columns)
+        self.assertEqual([datetime.datetime(2010, 2, 1), datetime.datetime(2010, 3, 1),
+                          datetime.datetime(2010, 4, 1)], reloaded.load(self.db_myengine))
+        reloaded = tzaware_datetime.TimePartitionedTable(MetaData(), 'events', 'tzawaredate',
+                                                         self.columns, period='day')
+        self.assertEqual(['events_20100227', 'events_20100228', 'events_20100301'],
+                         [reloaded.table(key).name for key in reloaded.load(self.db_myengine)])
+        self.assertRaises(ValueError, tzaware_datetime.TimePartitionedTable, MetaData(), 'events',
+                          'tzawaredate', period='week')
+
+class TestUTCFastPath(unittest.TestCase):
+    """Zero-offset values skip astimezone() but give the same results as converting"""
+    def setUp(self):
+        self.utc = dateutil.tz.tzutc()
+        self.wallclock = datetime.datetime(2010, 1, 20, 6, 30, 15, 250)
+
+    def assertSameDatetime(self, expected, actual):
+        self.assertEqual(expected, actual)
+        self.assertEqual(expected.replace(tzinfo=None), actual.replace(tzinfo=None))
+        self.assertEqual(expected.tzinfo, actual.tzinfo)
+        self.assertEqual(expected.utcoffset(), actual.utcoffset())
+        self.assertEqual(expected.tzname(), actual.tzname())
+
+    def test_set_realdate(self):
+        """UTC-equivalent inputs split into the same columns as before"""
+        for tzinfo in (self.utc, tzaware_datetime.tzinfo_registry.utc,
+                       dateutil.tz.tzoffset(None, 0), dateutil.tz.tzoffset('Z', 0),
+                       dateutil.tz.gettz('UTC'), dateutil.tz.gettz('Europe/London')):
+            realdate = self.wallclock.replace(tzinfo=tzinfo)
+            utcdt, tzname, offsetseconds = tzaware_datetime._composite_values_from_realdate(realdate)
+            self.assertSameDatetime(realdate.astimezone(tzaware_datetime.tzinfo_registry.utc), utcdt)
+            self.assertEqual(realdate.tzname(), tzname)
+            self.assertTrue(tzname is None or isinstance(tzname, unicode))
+            self.assertEqual(0, offsetseconds)
+        self.assertRaises(ValueError, tzaware_datetime._composite_values_from_realdate,
+                          self.wallclock)
+
+    def test_get_realdate(self):
+        """Offset 0 rebuilds the same datetime, with one shared tzinfo"""
+        zero = tzaware_datetime.tzinfo_registry.zero_offset
+        for utcdt in (self.wallclock, self.wallclock.replace(tzinfo=self.utc),
+                      self.wallclock.replace(tzinfo=dateutil.tz.gettz('Asia/Tokyo'))):
+            expected = utcdt.replace(tzinfo=self.utc).astimezone(dateutil.tz.tzoffset(None, 0))
+            realdate = tzaware_datetime.TZAwareDateTime(utcdt, u'UTC', 0).realdate
+            self.assertSameDatetime(expected, realdate)
+            self.assertTrue(realdate.tzinfo is zero)
+        # no offset is still returned as UTC
+        self.assertSameDatetime(self.wallclock.replace(tzinfo=self.utc),
+                                tzaware_datetime.TZAwareDateTime(self.wallclock).realdate)
+
+class TestColumnStore(unittest.TestCase):
+    """Chunked column file export and memory-mapped reading"""
+    def setUp(self):
+        self.db_myengine = create_engine('sqlite:///:memory:', echo=False)
+        self.dates = [datetime.datetime(2010, 1, 20, 6, 30, n, tzinfo=dateutil.tz.gettz(zone))
+                      for n, zone in enumerate(('Europe/Rome', 'America/Toronto', 'Asia/Tokyo',
+                                                'Europe/Rome', 'UTC') * 3)]
+        self.dates.append(datetime.datetime(1900, 1, 1, tzinfo=dateutil.tz.tzoffset(None, 19800)))
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def expected(self, storage='datetime'):
+        triples = []
+        for utcdt, tzname, offsetseconds in tzaware_datetime.bulk.composite_values(self.dates):
+            triples.append((utcdt.replace(tzinfo=None), tzname if storage == 'datetime' else None,
+                            offsetseconds))
+        return triples
+
+    def test_export(self):
+        """Rows exported from the database read back identically, with and without numpy"""
+        for storage in ('datetime', 'epoch'):
+            db_metadata = MetaData()
+            table_infomatic = Table('infomatic', db_metadata,
+                                    Column('id', Integer, primary_key=True))
+            tzaware_datetime.helper.append_columns(table_infomatic, 'tzawaredate', storage=storage)
+            db_metadata.create_all(self.db_myengine)
+            composite_class = tzaware_datetime._storage_layout(storage)[0]
+            self.db_myengine.execute(table_infomatic.insert(), [
+                dict(zip(['tzawaredate_%s' % key for key, name, coltype
+                          in tzaware_datetime._layout_specs(storage)[1]],
+                         composite_class(realdate=d).__composite_values__()))
+                for d in self.dates])
+            self.assertEqual(len(self.dates), tzaware_datetime.columnstore.export(
+                self.db_myengine, table_infomatic, 'tzawaredate', self.path,
+                order_by=table_infomatic.c.id, chunksize=4))
+            for use_numpy in (True, False):
+                with tzaware_datetime.ColumnStoreFile(self.path, use_numpy=use_numpy) as stored:
+                    self.assertEqual(len(self.dates), stored.rows)
+                    self.assertEqual(4, stored.chunkcount)
+                    self.assertEqual(self.expected(storage), list(stored.triples()))
+            db_metadata.drop_all(self.db_myengine)
+
+    def test_chunks(self):
+        """Columns are typed, None uses sentinels and names are stored once"""
+        triples = self.expected() + [(None, None, None)]
+        with open(self.path, 'wb') as fileobj:
+            self.assertEqual(17, tzaware_datetime.columnstore.write(fileobj, iter(triples)))
+        with tzaware_datetime.ColumnStoreFile(self.path, use_numpy=False) as stored:
+            self.assertEqual(1, stored.chunkcount)
+            self.assertEqual([u'CET', u'EST', u'JST', u'UTC'], stored.names)
+            micros, offsets, nameindexes = stored.chunk(0)
+            self.assertEqual(tzaware_datetime._utc_micros(triples[0][0]), micros[0])
+            self.assertEqual((-3600, 18000, -32400, -3600, 0), offsets[:5])
+            self.assertEqual((0, 1, 2, 0, 3), nameindexes[:5])
+            self.assertEqual((-2 ** 63, -2 ** 31, -1), (micros[-1], offsets[-1], nameindexes[-1]))
+            self.assertEqual(triples, list(stored.triples()))
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write('not a column store file')
+        self.assertRaises(ValueError, tzaware_datetime.ColumnStoreFile, self.path)
+
+    def test_truncated(self):
+        """Files shorter than the header and trailer raise ValueError"""
+        with open(self.path, 'wb') as fileobj:
+            tzaware_datetime.columnstore.write(fileobj, self.expected())
+        with open(self.path, 'rb') as fileobj:
+            data = fileobj.read()
+        for size in (1, 8, 16, 19):
+            with open(self.path, 'wb') as fileobj:
+                fileobj.write(data[:size])
+            self.assertRaises(ValueError, tzaware_datetime.ColumnStoreFile, self.path)
+
+    def test_bad_footer(self):
+        """Footer and chunk positions outside the file raise ValueError"""
+        with open(self.path, 'wb') as fileobj:
+            tzaware_datetime.columnstore.write(fileobj, self.expected(), chunksize=5)
+        with open(self.path, 'rb') as fileobj:
+            data = fileobj.read()
+        trailer = tzaware_datetime._COLUMNSTORE_TRAILER
+        footer = trailer.unpack_from(data, len(data) - trailer.size)[0]
+        def with_trailer(position):
+            return data[:-trailer.size] + trailer.pack(position, 'TZCS')
+        chunk_position = footer + 4
+        broken = [with_trailer(len(data)),
+                  # chunk count read from inside the trailer
+                  with_trailer(len(data) - trailer.size - 2),
+                  # first chunk moved past the footer
+                  data[:chunk_position] + struct.pack('<Q', footer) + data[chunk_position + 8:],
+                  # first chunk claims more rows than the file holds
+                  data[:chunk_position + 8] + struct.pack('<I', 10 ** 6) + data[chunk_position + 12:]]
+        for payload in broken:
+            with open(self.path, 'wb') as fileobj:
+                fileobj.write(payload)
+            self.assertRaises(ValueError, tzaware_datetime.ColumnStoreFile, self.path)
+
+    @unittest.skipIf(tzaware_datetime.numpy is None, 'numpy is not installed')
+    def test_views_outlive_close(self):
+        """Arrays from chunk() stay readable after the file is closed"""
+        with open(self.path, 'wb') as fileobj:
+            tzaware_datetime.columnstore.write(fileobj, self.expected(), chunksize=5)
+        with tzaware_datetime.ColumnStoreFile(self.path) as stored:
+            micros, offsets, nameindexes = stored.chunk(0)
+            expected = micros.tolist()
+        self.assertEqual(expected, micros.tolist())
+        self.assertEqual(sum(expected[:3]), micros[:3].sum())
+        self.assertRaises(ValueError, stored.chunk, 0)
+
+    @unittest.skipIf(tzaware_datetime.numpy is None, 'numpy is not installed')
+    def test_numpy_views(self):
+        """With numpy, chunk columns are arrays over the mapped file"""
+        with open(self.path, 'wb') as fileobj:
+            tzaware_datetime.columnstore.write(fileobj, self.expected(), chunksize=5)
+        with tzaware_datetime.ColumnStoreFile(self.path) as stored:
+            micros, offsets, nameindexes = stored.chunk(1)
+            self.assertEqual((tzaware_datetime.numpy.dtype('<i8'), 5), (micros.dtype, len(micros)))
+            self.assertEqual(tzaware_datetime.numpy.dtype('<i4'), offsets.dtype)
+            self.assertFalse(micros.flags.owndata)
+            self.assertFalse(micros.flags.writeable)
+            utc, offsets, local = tzaware_datetime.arrays.from_columns(
+                [d for d, tzname, offset in self.expected()[5:10]], offsets.tolist())
+            self.assertEqual(utc.tolist(), micros.view('datetime64[us]').tolist())
+
 class InfoMatic(object):
     """table to hold TZAwareDateTime values"""
     def __init__(self, info, tzawaredate):
@@ -299,8 +1931,27 @@ def run_all_tests():
 
     # add all TestCase subclasses
     allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestBasicClass))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestRealdateCache))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestTZInfoRegistry))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSlottedVariants))
     allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestDatabaseAccess))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestComparator))
     allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestDatabaseSetupHelper))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestIndexes))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestBulk))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestArrays))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestStream))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestEpochStorage))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestZoneNames))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestInstrumentation))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestNamedZones))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestIngest))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSerialization))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestChangeTracking))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestLocalTime))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestTimePartitions))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestUTCFastPath))
+    allsuites.addTests(unittest.TestLoader().loadTestsFromTestCase(TestColumnStore))
     unittest.TextTestRunner(verbosity=2).run(allsuites)
 
 if __name__ == '__main__':
@@ -4,7 +4,7 @@
 
 Usage:
   Add the following columns to the table definition:
-    Column('utcdate', DateTime),
+    Column('utcdate', UTCDateTime),
     Column('tzname', Unicode),
     Column('tzoffset', Integer))
 
@@ -12,9 +12,13 @@ Usage:
   'tzawaredate': composite(TZAwareDateTime, 
                             thetable.c.utcdate, 
                             thetable.c.tzname,
-                            thetable.c.tzoffset)
+                            thetable.c.tzoffset,
+                            comparator_factory=TZAwareDateTimeComparator)
                             
   The columns can be named anything, but they must exist with those types and be reference in that order.
+  comparator_factory is optional; it makes filters and ORDER BY use the UTC column alone.
+  UTCDateTime creates a plain DateTime column; unlike DateTime it lets in-place
+  changes to loaded values (e.g. setting .realdate) be detected at flush.
 """
 __version_info__ = ('0', '5', '0')
 __version__ = '.'.join(__version_info__)
@@ -22,29 +26,268 @@ __author__ = 'Andrew Ittner <aji@rhymingpanda.com>'
 __copyright__ = "Public Domain (CC0) <http://creativecommons.org/publicdomain/zero/1.0/>"
 
 # stdlib
+import re
+import sys
+import struct
+import mmap
+import multiprocessing
 from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from functools import total_ordering
+from itertools import islice
+from operator import itemgetter
+from timeit import default_timer
+import threading
 
 # sqlalchemy
-from sqlalchemy import Column, DateTime, Unicode, Integer
+from sqlalchemy import Table, Column, DateTime, Date, Unicode, Integer, BigInteger, SmallInteger
+from sqlalchemy import Index, exc
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import composite
+from sqlalchemy.orm.properties import CompositeProperty
+from sqlalchemy.orm.interfaces import MapperExtension, EXT_CONTINUE
+from sqlalchemy.sql import operators, bindparam, select, and_, union_all
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.sql.expression import FunctionElement
 
 # dateutil <http://labix.org/python-dateutil>
 from dateutil import tz
+from dateutil import parser as dateutil_parser
+
+# optional: numpy <http://numpy.scipy.org/>, used by the arrays helpers when installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class UTCDateTime(TypeDecorator):
+    """DateTime column for the UTC date that compares naive and aware values by instant
+
+    The ORM snapshots each loaded composite and compares it with the current
+    value at flush; values loaded from the database hold naive UTC datetimes,
+    values set through .realdate hold aware ones.
+    """
+    impl = DateTime
+
+    def compare_values(self, x, y):
+        return _utc_key(x) == _utc_key(y)
 
 # module-level data
-TZAwareDateTimeColumns = (Column('utcdate', DateTime),
+TZAwareDateTimeColumns = (Column('utcdate', UTCDateTime),
                           Column('tzname', Unicode),
                           Column('tzoffset', Integer))
 TZAwareDateTimeColumnNames = ('utcdate', 'tzname', 'tzoffset')
 
-class TZAwareDateTime(object):
-    """A composite sqlalchemy column that round-trips timezone-aware datetime objects"""
+# start of the integer epoch storage layout, and its proleptic Gregorian ordinal
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+
+# marks a TZAwareDateTime whose .realdate has not been computed yet
+_REALDATE_UNSET = object()
+
+# marks a (zone name, offset, UTC day) not yet checked by TZInfoRegistry.zone_day
+_ZONE_DAY_UNCHECKED = object()
+
+def _realdate_clearing_property(attrname, doc):
+    """property over a composite attribute; setting it discards the cached .realdate"""
+    def getter(self):
+        return getattr(self, attrname)
+    def setter(self, value):
+        setattr(self, attrname, value)
+        self._realdate = _REALDATE_UNSET
+    return property(getter, setter, doc=doc)
+
+def _offset_seconds(tdelta):
+    """seconds between local date and UTC for a utcoffset() timedelta"""
+    return (-tdelta.days * 86400) - tdelta.seconds
+
+def _composite_values_from_realdate(newdate):
+    """split a timezone-aware datetime into (utcdt, tzname, offsetseconds)"""
+    # get timezone name
+    newtzname = newdate.tzname()
+    if newtzname is not None:
+        newtzname = unicode(newtzname)
+    tdelta = newdate.utcoffset()
+    if tdelta is not None and not tdelta:
+        # already UTC: astimezone() would only relabel it
+        return (newdate.replace(tzinfo=tzinfo_registry.utc), newtzname, 0)
+    return (newdate.astimezone(tzinfo_registry.utc),
+            newtzname,
+            _offset_seconds(tdelta))
+
+def _offset_realdate(utcdt, offsetseconds):
+    """timezone-aware date at a fixed offset from a UTC datetime (naive or aware)"""
+    tz_reconstitute = None
+    if offsetseconds is None:
+        # return date as UTC
+        if utcdt is None:
+            return None
+        return utcdt.replace(tzinfo=tzinfo_registry.utc)
+    elif offsetseconds == 0:
+        # converting to a zero offset keeps the wall clock, so only relabel it
+        return utcdt.replace(tzinfo=tzinfo_registry.zero_offset)
+    else:
+        tz_reconstitute = tzinfo_registry.offset(offsetseconds)
+        
+    # get naive date in UTC timezone, convert to non-naive, offset to given timezone
+    return utcdt.replace(tzinfo=tzinfo_registry.utc).astimezone(tz_reconstitute)
+
+def _zone_key(tzinfo):
+    """IANA key (e.g. 'America/Toronto') of a named-zone tzinfo, or None"""
+    # pytz and zoneinfo
+    for attrname in ('zone', 'key'):
+        key = getattr(tzinfo, attrname, None)
+        if isinstance(key, basestring):
+            return key
+    # dateutil tzfile: path to the zoneinfo file, or the key itself
+    filename = getattr(tzinfo, '_filename', None)
+    if isinstance(filename, basestring):
+        position = filename.rfind('zoneinfo/')
+        if position >= 0:
+            return filename[position + len('zoneinfo/'):]
+        if not filename.startswith('/'):
+            return filename
+    return None
+
+def _utc_key(utcdt):
+    """naive UTC datetime used to compare, hash and sort values (None when empty)"""
+    if utcdt is not None and utcdt.tzinfo is not None:
+        return utcdt.astimezone(tzinfo_registry.utc).replace(tzinfo=None)
+    return utcdt
+
+def _utc_micros(utcdt):
+    """microseconds since 1970-01-01 for a naive UTC datetime"""
+    return ((utcdt.toordinal() - _EPOCH_ORDINAL) * 86400000000
+            + (utcdt.hour * 3600 + utcdt.minute * 60 + utcdt.second) * 1000000
+            + utcdt.microsecond)
+
+def _from_utc_micros(micros):
+    """naive UTC datetime for microseconds since 1970-01-01"""
+    return _EPOCH + timedelta(microseconds=micros)
+
+def _restore(cls, utcmicros, offsetseconds, tzname, aware=False):
+    """rebuild a value reduced by _TZAwareDateTimeBase.__reduce__ or packed.encode"""
+    utcdt = None
+    if utcmicros is not None:
+        utcdt = _from_utc_micros(utcmicros)
+        if aware:
+            utcdt = utcdt.replace(tzinfo=tzinfo_registry.utc)
+    return cls._from_storage(utcdt, tzname, offsetseconds)
+
+class TZInfoRegistry(object):
+    """Bounded, thread-safe cache of shared tzinfo objects
+
+    Identical offsets (and zone names) resolve to a single tzinfo instance,
+    so large result sets do not allocate one tzinfo per row.  Least recently
+    used entries are evicted once maxsize is reached; maxsize=0 disables
+    caching and builds a new tzinfo for every request.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.utc = tz.tzutc()
+        # what .realdate carries for rows stored with offset 0
+        self.zero_offset = tz.tzoffset(None, 0)
+        # (zone name, offsetseconds, UTC day ordinal): (zone, offset timedelta), or None
+        # when the zone does not keep that offset all day (see zone_day)
+        self.zone_days = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def offset(self, offsetseconds, name=None):
+        """return a shared tzoffset for offsetseconds (optionally labelled name)"""
+        return self._lookup(('offset', name, offsetseconds),
+                            tz.tzoffset, name, offsetseconds)
+
+    def zone(self, name):
+        """return a shared tzinfo for a zone name, or None if it cannot be resolved"""
+        return self._lookup(('zone', name), tz.gettz, name)
+
+    def _lookup(self, key, factory, *args):
+        with self._lock:
+            try:
+                # re-insert to mark as most recently used
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries[key] = value
+                return value
+        value = self._create(factory, *args)
+        if self.maxsize > 0:
+            with self._lock:
+                # another thread may have stored an equal tzinfo meanwhile
+                value = self._entries.setdefault(key, value)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def zone_day(self, name, offsetseconds, ordinal):
+        """(zone, offset timedelta) if zone name keeps offsetseconds for the whole UTC day
+        ordinal, else None; results are cached in zone_days (at most maxsize days)
+
+        Checks utcoffset() at the first and last wall-clock instant of the day,
+        so it assumes a zone never changes its offset twice within 24 hours."""
+        zone = self.zone(name)
+        day = None
+        if zone is not None:
+            offset = timedelta(seconds=offsetseconds)
+            try:
+                first = datetime.fromordinal(ordinal) - offset
+                last = first + timedelta(days=1, microseconds=-1)
+            except OverflowError:
+                first = last = None
+            if (first is not None
+                    and _offset_seconds(first.replace(tzinfo=zone).utcoffset()) == offsetseconds
+                    and _offset_seconds(last.replace(tzinfo=zone).utcoffset()) == offsetseconds):
+                day = (zone, offset)
+        if self.maxsize > 0:
+            if len(self.zone_days) >= self.maxsize:
+                self.zone_days.clear()
+            self.zone_days[name, offsetseconds, ordinal] = day
+        return day
+
+    def prewarm(self, names):
+        """resolve zone names ahead of time; return those that resolved"""
+        return [name for name in names if self.zone(name) is not None]
+
+    def _create(self, factory, *args):
+        """build a new tzinfo (a separate method so instrumentation can time it)"""
+        return factory(*args)
+
+    def stats(self):
+        """return a dict of hits, misses, current size and maxsize"""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries),
+                    'maxsize': self.maxsize}
+
+    def clear(self):
+        """drop all cached tzinfo objects and reset statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.zone_days.clear()
+            self.hits = 0
+            self.misses = 0
+
+# process-wide registry used by TZAwareDateTime
+tzinfo_registry = TZInfoRegistry()
+
+class _TZAwareDateTimeBase(object):
+    """behaviour shared by TZAwareDateTime and its slotted variants"""
+    __slots__ = ()
+
     def __init__(self, utcdt=None, tzname=None, offsetseconds=None, realdate=None):
         """utcdt: UTC datetime
         tzname: human-readable timezone name
         offsetseconds: seconds between local date and UTC
         realdate: actual date in target timezone
         """
+        self._realdate = _REALDATE_UNSET
         if (realdate is None):
             self.utcdt = utcdt
             self.tzname = tzname
@@ -61,6 +304,11 @@ class TZAwareDateTime(object):
             return "<TZDateTime (%s, offset=%s)>" % (self.realdate, 
                                                      self.offsetseconds)
         
+    utcdt = _realdate_clearing_property('_utcdt', 'UTC datetime')
+    tzname = _realdate_clearing_property('_tzname', 'human-readable timezone name')
+    offsetseconds = _realdate_clearing_property('_offsetseconds',
+                                                'seconds between local date and UTC')
+
     def __composite_values__(self):
         return [self.utcdt, self.tzname, self.offsetseconds]
 
@@ -68,7 +316,34 @@ class TZAwareDateTime(object):
         self.utcdt = utcdt
         self.tzname = tzname
         self.offsetseconds = offsetseconds
-        
+
+    @classmethod
+    def _from_storage(cls, utcdt, tzname, offsetseconds):
+        """new instance holding already-validated column values (skips __init__)"""
+        value = cls.__new__(cls)
+        value._utcdt = utcdt
+        value._tzname = tzname
+        value._offsetseconds = offsetseconds
+        value._realdate = _REALDATE_UNSET
+        return value
+
+    def __reduce__(self):
+        """pickle as (UTC microseconds, offsetseconds, tzname), without tzinfo objects"""
+        utcdt = self.utcdt
+        if utcdt is None:
+            return (_restore, (type(self), None, self.offsetseconds, self.tzname))
+        args = (type(self), _utc_micros(_utc_key(utcdt)), self.offsetseconds, self.tzname)
+        if utcdt.tzinfo is not None:
+            args += (True,)
+        return (_restore, args)
+
+    def __setstate__(self, state):
+        """load values pickled before __reduce__, whose state is the plain __dict__"""
+        self._utcdt = state.get('utcdt')
+        self._tzname = state.get('tzname')
+        self._offsetseconds = state.get('offsetseconds')
+        self._realdate = _REALDATE_UNSET
+
     def __eq__(self, other):
         return other.utcdt == self.utcdt
     
@@ -78,80 +353,1546 @@ class TZAwareDateTime(object):
     def _calc_offset_seconds(self, tdelta):
         """calculate timedelta seconds based on day value"""
         assert isinstance(tdelta, timedelta)
-        return (-tdelta.days * 86400) - tdelta.seconds
+        return _offset_seconds(tdelta)
     
     def _get_realdate(self):
+        """return the timezone-aware date, reconstructing it only when the columns changed"""
+        if self._realdate is _REALDATE_UNSET:
+            self._realdate = self._build_realdate()
+        return self._realdate
+
+    def _build_realdate(self):
         """reconstruct timezone-aware date from 3 columns"""
-        tz_reconstitute = None
         # use offset from UTC (timezone name not guaranteed for roundtrip)
-        if self.offsetseconds is None:
-            # return date as UTC
-            if self.utcdt is None:
-                return None
-            return self.utcdt.replace(tzinfo=tz.tzutc())
-        else:
-            tz_reconstitute = tz.tzoffset(name=None, offset=self.offsetseconds)
-            
-        # get naive date in UTC timezone, convert to non-naive, offset to given timezone
-        return self.utcdt.replace(tzinfo=tz.tzutc()).astimezone(tz_reconstitute)
+        return _offset_realdate(self.utcdt, self.offsetseconds)
+    
+    def _set_realdate(self, newdate):
+        """use a single datetime with a timezone to set class values"""
+        self.utcdt, self.tzname, self.offsetseconds = _composite_values_from_realdate(newdate)
     
+    realdate = property(_get_realdate, _set_realdate)
+
+class TZAwareDateTime(_TZAwareDateTimeBase):
+    """A composite sqlalchemy column that round-trips timezone-aware datetime objects"""
+
+class NamedZoneTZAwareDateTime(TZAwareDateTime):
+    """TZAwareDateTime that stores the IANA zone key (e.g. America/Toronto) as tzname
+
+    .realdate is rebuilt in that zone, so arithmetic follows its DST rules.
+    Zones resolve through tzinfo_registry (see TZInfoRegistry.prewarm); when
+    the stored name does not resolve, or disagrees with the stored offset,
+    .realdate carries a fixed offset with the same wall clock and utcoffset().
+    """
+    def _build_realdate(self):
+        """reconstruct timezone-aware date in the named zone, if it resolves"""
+        utcdt, tzname, offsetseconds = self._utcdt, self._tzname, self._offsetseconds
+        if utcdt is not None and tzname is not None:
+            if offsetseconds is not None:
+                # on days the zone keeps the stored offset throughout, the wall
+                # clock follows from the offset alone: no utcoffset() per value
+                key = (tzname, offsetseconds, utcdt.toordinal())
+                day = tzinfo_registry.zone_days.get(key, _ZONE_DAY_UNCHECKED)
+                if day is _ZONE_DAY_UNCHECKED:
+                    day = tzinfo_registry.zone_day(*key)
+                if day is not None:
+                    zone, offset = day
+                    return (utcdt.replace(tzinfo=None) - offset).replace(tzinfo=zone)
+            zone = tzinfo_registry.zone(tzname)
+            if zone is not None:
+                if offsetseconds is None:
+                    return utcdt.replace(tzinfo=tzinfo_registry.utc).astimezone(zone)
+                # the stored offset gives the wall clock directly; one utcoffset()
+                # call confirms it (astimezone() costs several on tzfile zones)
+                realdate = (utcdt.replace(tzinfo=None)
+                            - timedelta(seconds=offsetseconds)).replace(tzinfo=zone)
+                if _offset_seconds(realdate.utcoffset()) == offsetseconds:
+                    return realdate
+                # ambiguous wall clock (end of DST), or the zone's rules changed
+                realdate = utcdt.replace(tzinfo=tzinfo_registry.utc).astimezone(zone)
+                if _offset_seconds(realdate.utcoffset()) == offsetseconds:
+                    return realdate
+        if offsetseconds is None:
+            return _offset_realdate(utcdt, offsetseconds)
+        # same wall clock and utcoffset() as a zone keeping the stored offset
+        return _offset_realdate(utcdt, -offsetseconds)
+
+    def _set_realdate(self, newdate):
+        """use a single datetime with a timezone to set class values, keeping its zone key"""
+        utcdt, tzname, offsetseconds = _composite_values_from_realdate(newdate)
+        key = _zone_key(newdate.tzinfo)
+        if key is not None and tzinfo_registry.zone(key) is not None:
+            tzname = unicode(key)
+        self.utcdt, self.tzname, self.offsetseconds = utcdt, tzname, offsetseconds
+
+    realdate = property(_TZAwareDateTimeBase._get_realdate, _set_realdate)
+
+class SlottedTZAwareDateTime(_TZAwareDateTimeBase):
+    """TZAwareDateTime without a per-instance __dict__, for holding many values in memory"""
+    __slots__ = ('_utcdt', '_tzname', '_offsetseconds', '_realdate')
+
+@total_ordering
+class FrozenTZAwareDateTime(_TZAwareDateTimeBase):
+    """Immutable, hashable TZAwareDateTime that compares, hashes and sorts by UTC instant
+
+    Values cannot be modified in place; map it with composite() only where
+    whole values are assigned.
+    """
+    __slots__ = ('_utcdt', '_tzname', '_offsetseconds', '_realdate', '_utckey')
+
+    def __init__(self, utcdt=None, tzname=None, offsetseconds=None, realdate=None):
+        if realdate is not None:
+            utcdt, tzname, offsetseconds = _composite_values_from_realdate(realdate)
+        self._utcdt = utcdt
+        self._tzname = tzname
+        self._offsetseconds = offsetseconds
+        self._realdate = _REALDATE_UNSET
+        self._utckey = _utc_key(utcdt)
+
+    utcdt = property(lambda self: self._utcdt, doc='UTC datetime')
+    tzname = property(lambda self: self._tzname, doc='human-readable timezone name')
+    offsetseconds = property(lambda self: self._offsetseconds,
+                             doc='seconds between local date and UTC')
+    realdate = property(_TZAwareDateTimeBase._get_realdate)
+
+    def __set_composite_values__(self, utcdt, tzname, offsetseconds):
+        raise TypeError('%s is immutable' % type(self).__name__)
+
+    @classmethod
+    def _from_storage(cls, utcdt, tzname, offsetseconds):
+        value = super(FrozenTZAwareDateTime, cls)._from_storage(utcdt, tzname, offsetseconds)
+        value._utckey = _utc_key(utcdt)
+        return value
+
+    def _sort_key(self):
+        # empty values sort first
+        return (self._utckey is not None, self._utckey)
+
+    def __eq__(self, other):
+        if not isinstance(other, _TZAwareDateTimeBase):
+            return NotImplemented
+        return self._utckey == _utc_key(other.utcdt)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __lt__(self, other):
+        if not isinstance(other, _TZAwareDateTimeBase):
+            return NotImplemented
+        other_key = _utc_key(other.utcdt)
+        return self._sort_key() < (other_key is not None, other_key)
+
+    def __hash__(self):
+        return hash(self._utckey)
+
+class EpochTZAwareDateTime(_TZAwareDateTimeBase):
+    """TZAwareDateTime for the epoch storage layout: UTC microseconds and offset columns
+
+    The timezone name is not stored, so tzname is always None.
+    """
+    def __init__(self, utcdt=None, offsetseconds=None, realdate=None):
+        _TZAwareDateTimeBase.__init__(self, utcdt, None, offsetseconds, realdate)
+
+    def __composite_values__(self):
+        return [self.utcdt, self.offsetseconds]
+
+    def __set_composite_values__(self, utcdt, offsetseconds):
+        self.utcdt = utcdt
+        self.offsetseconds = offsetseconds
+
     def _set_realdate(self, newdate):
         """use a single datetime with a timezone to set class values"""
-        # convert to utc
-        self.utcdt = newdate.astimezone(tz.tzutc())
+        self.utcdt, tzname, self.offsetseconds = _composite_values_from_realdate(newdate)
+        self.tzname = None
+
+    realdate = property(_TZAwareDateTimeBase._get_realdate, _set_realdate)
+
+class UTCMicroseconds(TypeDecorator):
+    """BigInteger column holding a UTC instant as microseconds since 1970-01-01
+
+    Binds naive (taken as UTC) or aware datetimes, and returns naive UTC datetimes.
+    """
+    impl = BigInteger
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, (int, long)):
+            return value
+        return _utc_micros(_utc_key(value))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return _from_utc_micros(value)
+
+    def compare_values(self, x, y):
+        return _utc_key(x) == _utc_key(y)
+
+# epoch storage layout: one integer for the instant, one for the offset
+TZAwareDateTimeEpochColumns = (Column('utcmicros', UTCMicroseconds),
+                               Column('tzoffset', Integer))
+TZAwareDateTimeEpochColumnNames = ('utcmicros', 'tzoffset')
+
+# storage name: (composite class, template columns)
+_STORAGE_LAYOUTS = {'datetime': (TZAwareDateTime, TZAwareDateTimeColumns),
+                    'epoch': (EpochTZAwareDateTime, TZAwareDateTimeEpochColumns)}
+
+def _storage_layout(storage):
+    try:
+        return _STORAGE_LAYOUTS[storage]
+    except KeyError:
+        raise ValueError('unknown TZAwareDateTime storage %r (expected one of %s)'
+                         % (storage, ', '.join(sorted(_STORAGE_LAYOUTS))))
 
-        # get timezone name
-        newtzname = newdate.tzname()
-        if newtzname is not None:
-            self.tzname = unicode(newtzname)
+# storage name: (composite class, ((key, name, type) of each template column))
+_LAYOUT_SPECS = {}
+
+def _layout_specs(storage):
+    """composite class and column specs of a storage layout, read from its template once"""
+    try:
+        return _LAYOUT_SPECS[storage]
+    except KeyError:
+        layout_class, template = _storage_layout(storage)
+        specs = _LAYOUT_SPECS[storage] = (layout_class,
+                                          tuple((c.key, c.name, c.type) for c in template))
+        return specs
+
+# template column key: position of its value in a (utcdt, tzname, offsetseconds) triple
+_TRIPLE_POSITIONS = {'utcdate': 0, 'utcmicros': 0, 'tzname': 1, 'tzoffset': 2}
+
+def _table_storage(table, columnname):
+    """storage layout of the columns helper.append_columns added to table under columnname"""
+    for storage in sorted(_STORAGE_LAYOUTS):
+        specs = _layout_specs(storage)[1]
+        if all('%s_%s' % (columnname, key) in table.c for key, name, coltype in specs):
+            return storage
+    raise ValueError('%s has no TZAwareDateTime columns for %r' % (table.name, columnname))
+
+def _triple_layout(columnname, storage):
+    """(column keys, function picking their values out of a triple) of a storage layout"""
+    specs = _layout_specs(storage)[1]
+    return (['%s_%s' % (columnname, key) for key, name, coltype in specs],
+            itemgetter(*[_TRIPLE_POSITIONS[key] for key, name, coltype in specs]))
+
+def _outer_transaction(connectable):
+    """the outermost transaction a Connection is in, or None (Engines, autocommit)"""
+    # Connection has no public accessor for its transaction
+    transaction = getattr(connectable, '_Connection__transaction', None)
+    while transaction is not None and transaction._parent is not transaction:
+        transaction = transaction._parent
+    return transaction
+
+class ZoneNameRegistry(object):
+    """Maps timezone names to small integer ids kept in a shared lookup table
+
+    Known names resolve from an in-process cache. New names are added on the
+    connection doing the write, inside its transaction: bulk, ingest,
+    migrate_storage and TimePartitionedTable add each chunk's names before
+    executing it, and the composites of helper.get_mapper_definition add
+    them before the ORM flushes a row. Other writers call
+    id_for(name, connection) first. An id added inside a transaction is only
+    cached once a later lookup finds it committed, so a rollback leaves
+    nothing behind. Comparisons only look names up: an unknown name matches
+    no row. Use with helper.append_columns(..., zones=registry).
+    """
+    def __init__(self, metadata, tablename='tzaware_zonenames', bind=None):
+        """metadata: MetaData the lookup table is defined in
+        bind: Engine used to look names up (defaults to metadata.bind), and to add
+          them when id_for() is called without a connection"""
+        self.table = Table(tablename, metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('name', Unicode(255), nullable=False, unique=True))
+        self.bind = bind
+        self._ids = {}
+        self._names = {}
+        # name: (id, transaction) added by transactions of this thread
+        self._local = threading.local()
+
+    def _connectable(self, connection=None):
+        connectable = connection or self.bind or self.table.bind
+        if connectable is None:
+            raise exc.UnboundExecutionError('ZoneNameRegistry for %s is not bound to an Engine'
+                                            % self.table.name)
+        return connectable
+
+    def _remember(self, zoneid, name):
+        self._ids[name] = zoneid
+        self._names[zoneid] = name
+
+    def _pending(self):
+        """name: (id, transaction) of names this thread added in still-open transactions"""
+        try:
+            pending = self._local.pending
+        except AttributeError:
+            pending = self._local.pending = {}
+        for name, (zoneid, transaction) in pending.items():
+            if not transaction.is_active:
+                # committed or rolled back: the next lookup finds out which
+                del pending[name]
+        return pending
+
+    def _select_id(self, connectable, name):
+        return connectable.execute(select([self.table.c.id], self.table.c.name == name)).scalar()
+
+    def load(self):
+        """read every known name into the cache (e.g. at startup)"""
+        for zoneid, name in self._connectable().execute(self.table.select()):
+            self._remember(zoneid, name)
+
+    def id_for(self, name, connection=None):
+        """return the id for name, adding it to the lookup table if it is new
+
+        connection: Engine or Connection to add the name on (defaults to bind);
+          inside a transaction the name commits or rolls back with it"""
+        try:
+            return self._ids[name]
+        except KeyError:
+            pass
+        connectable = self._connectable(connection)
+        transaction = _outer_transaction(connectable)
+        pending = self._pending()
+        if name in pending and pending[name][1] is transaction:
+            return pending[name][0]
+        zoneid = self._select_id(connectable, name)
+        if zoneid is not None:
+            if name not in pending:
+                self._remember(zoneid, name)
+            return zoneid
+        try:
+            zoneid = connectable.execute(self.table.insert(), name=name).inserted_primary_key[0]
+        except exc.IntegrityError:
+            if transaction is not None:
+                # the caller's transaction may be unusable now (e.g. on PostgreSQL)
+                raise
+            # added by another process since the lookup
+            zoneid = self._select_id(connectable, name)
+        if transaction is None:
+            self._remember(zoneid, name)
         else:
-            self.tzname = None
+            pending[name] = (zoneid, transaction)
+        return zoneid
 
-        # set offset
-        self.offsetseconds = self._calc_offset_seconds(newdate.utcoffset())
-    
-    realdate = property(_get_realdate, _set_realdate)
+    def lookup(self, name):
+        """return the id for name, or None when it has none; never adds it"""
+        try:
+            return self._ids[name]
+        except KeyError:
+            pass
+        pending = self._pending()
+        if name in pending:
+            return pending[name][0]
+        zoneid = self._select_id(self._connectable(), name)
+        if zoneid is not None:
+            self._remember(zoneid, name)
+        return zoneid
+
+    def _bound_id(self, name):
+        """id for a name being written: added earlier by id_for on the writing connection"""
+        try:
+            return self._ids[name]
+        except KeyError:
+            pass
+        pending = self._pending()
+        if name in pending:
+            return pending[name][0]
+        raise exc.InvalidRequestError('timezone name %r has no id in %s; add it with '
+                                      'id_for(name, connection) on the connection writing it'
+                                      % (name, self.table.name))
+
+    def name_for(self, zoneid):
+        """return the name stored under zoneid"""
+        try:
+            return self._names[zoneid]
+        except KeyError:
+            pass
+        for name, (pending_id, transaction) in self._pending().items():
+            if pending_id == zoneid:
+                return name
+        name = self._connectable().execute(select([self.table.c.name],
+                                                  self.table.c.id == zoneid)).scalar()
+        if name is None:
+            raise KeyError('unknown timezone name id %r' % (zoneid,))
+        self._remember(zoneid, name)
+        return name
+
+    def register(self, connection, names):
+        """add any new names (None allowed) on connection, e.g. before writing a chunk"""
+        for name in set(names):
+            if name is not None and name not in self._ids:
+                self.id_for(name, connection)
+
+# bound for names with no id, so comparisons (including !=) behave as for a missing name
+_UNKNOWN_ZONE_ID = -1
+
+class ZoneId(TypeDecorator):
+    """SmallInteger column storing timezone names as ids from a ZoneNameRegistry
+
+    Written names must have been added on the writing connection first (see
+    ZoneNameRegistry); names compared against are only looked up."""
+    impl = SmallInteger
+
+    def __init__(self, registry):
+        TypeDecorator.__init__(self)
+        self.registry = registry
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return self.registry._bound_id(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self.registry.name_for(value)
+
+    def coerce_compared_value(self, op, value):
+        return _ZoneIdLookup(self.registry)
+
+class _ZoneIdLookup(ZoneId):
+    """ZoneId of comparison operands: looks names up without adding them"""
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        zoneid = self.registry.lookup(value)
+        if zoneid is None:
+            return _UNKNOWN_ZONE_ID
+        return zoneid
+
+def _zone_columns(table):
+    """(column key, ZoneNameRegistry) of each ZoneId column in table"""
+    return [(c.key, c.type.registry) for c in table.c if isinstance(c.type, ZoneId)]
+
+class _ZoneNameExtension(MapperExtension):
+    """adds the timezone name of a composite to its registry on the flush connection"""
+    def __init__(self, key, position, registry):
+        self.key = key
+        self.position = position
+        self.registry = registry
+
+    def before_insert(self, mapper, connection, instance):
+        value = getattr(instance, self.key)
+        if value is not None:
+            name = value.__composite_values__()[self.position]
+            if name is not None:
+                self.registry.id_for(name, connection)
+        return EXT_CONTINUE
+
+    before_update = before_insert
+
+class _ZoneNameCompositeProperty(CompositeProperty):
+    """composite over ZoneId columns; new names are added before each row is flushed"""
+    def do_init(self):
+        super(_ZoneNameCompositeProperty, self).do_init()
+        for position, column in enumerate(self.columns):
+            if isinstance(column.type, ZoneId):
+                extension = _ZoneNameExtension(self.key, position, column.type.registry)
+                for mapper in self.parent.polymorphic_iterator():
+                    mapper.extension.append(extension)
+
+class local_datetime(FunctionElement):
+    """SQL local date and time of a UTC column and its tzoffset column
+
+      local_datetime(thetable.c.utcdate, thetable.c.tzoffset)
+
+    local = UTC - tzoffset seconds (a NULL offset is taken as UTC); the UTC
+    column may be a DateTime or a UTCMicroseconds (epoch storage) column.
+    Compiles for SQLite and PostgreSQL. Label it in Core select()s so results
+    are converted to datetime/date.
+    """
+    type = DateTime()
+    name = 'local_datetime'
+
+class local_date(local_datetime):
+    """SQL local calendar date of a UTC column and its tzoffset column"""
+    type = Date()
+    name = 'local_date'
+
+class local_hour(local_datetime):
+    """SQL local date and time truncated to the hour, of a UTC column and its tzoffset column"""
+    type = DateTime()
+    name = 'local_hour'
+
+def _local_operands(element, compiler, **kw):
+    """(compiled UTC column, compiled offset in seconds, whether UTC is epoch microseconds)"""
+    column_utc, column_tzoffset = element.clauses.clauses
+    return (compiler.process(column_utc, **kw),
+            'COALESCE(%s, 0)' % compiler.process(column_tzoffset, **kw),
+            isinstance(column_utc.type, UTCMicroseconds))
+
+@compiles(local_datetime)
+def _compile_local_datetime(element, compiler, **kw):
+    raise exc.CompileError('%s is not supported on %s (only sqlite and postgresql)'
+                           % (element.name, compiler.dialect.name))
+
+@compiles(local_datetime, 'sqlite')
+def _compile_local_datetime_sqlite(element, compiler, **kw):
+    utc, offset, epoch = _local_operands(element, compiler, **kw)
+    # sqlite date functions round to milliseconds, so only whole seconds are
+    # passed in and the microseconds (unchanged by a whole-second offset) appended
+    if epoch:
+        micros = '((%s) %% 1000000 + 1000000) %% 1000000' % utc
+        args = '((%s) - %s) / 1000000 - %s, \'unixepoch\'' % (utc, micros, offset)
+        # DateTime columns on sqlite carry microseconds as a .ffffff suffix
+        fraction = 'printf(\'.%%06d\', %s)' % micros
+    else:
+        args = 'substr(%s, 1, 19), (-%s) || \' seconds\'' % (utc, offset)
+        fraction = 'substr(%s, 20)' % utc
+    if isinstance(element, local_date):
+        return 'date(%s)' % args
+    if isinstance(element, local_hour):
+        return 'strftime(\'%%Y-%%m-%%d %%H:00:00\', %s)' % args
+    return 'datetime(%s) || %s' % (args, fraction)
+
+@compiles(local_datetime, 'postgresql')
+def _compile_local_datetime_postgresql(element, compiler, **kw):
+    utc, offset, epoch = _local_operands(element, compiler, **kw)
+    if epoch:
+        local = ('(TIMESTAMP \'epoch\' + ((%s) - %s * 1000000) * INTERVAL \'1 microsecond\')'
+                 % (utc, offset))
+    else:
+        local = '(%s - %s * INTERVAL \'1 second\')' % (utc, offset)
+    if isinstance(element, local_date):
+        return 'CAST(%s AS DATE)' % local
+    if isinstance(element, local_hour):
+        return 'date_trunc(\'hour\', %s)' % local
+    return local
+
+def _utc_operand(value):
+    """convert a comparison operand to the naive UTC value stored in the utcdate column"""
+    if isinstance(value, _TZAwareDateTimeBase):
+        return _utc_key(value.utcdt)
+    if isinstance(value, datetime):
+        if value.tzinfo is None or value.utcoffset() is None:
+            raise ValueError('cannot compare a TZAwareDateTime column with a naive datetime: %r'
+                             % (value,))
+        return _utc_key(value)
+    if isinstance(value, (list, tuple)):
+        return [_utc_operand(v) for v in value]
+    # None, SQL expressions and other columns pass through
+    return value
+
+class TZAwareDateTimeComparator(CompositeProperty.Comparator):
+    """Compares and sorts a TZAwareDateTime composite by its UTC column alone
+
+    Operands may be TZAwareDateTime values or timezone-aware datetimes, so
+    range filters and ORDER BY can use an index on the utcdate column:
+      composite(TZAwareDateTime, thetable.c.utcdate, thetable.c.tzname, thetable.c.tzoffset,
+                comparator_factory=TZAwareDateTimeComparator)
+    local_datetime(), local_date() and local_hour() compute local time in SQL,
+    e.g. session.query(InfoMatic.tzawaredate.local_date(), func.count()).group_by(...)
+    """
+    def __clause_element__(self):
+        column_utcdate = self.prop.columns[0]
+        if self.adapter:
+            return self.adapter(column_utcdate)
+        return column_utcdate
+
+    def operate(self, op, *other, **kwargs):
+        return op(self.__clause_element__(), *[_utc_operand(o) for o in other], **kwargs)
+
+    def reverse_operate(self, op, other, **kwargs):
+        return op(_utc_operand(other), self.__clause_element__(), **kwargs)
+
+    def __eq__(self, other):
+        return self.operate(operators.eq, other)
+
+    def __ne__(self, other):
+        return self.operate(operators.ne, other)
+
+    def _local(self, function):
+        column_utc, column_tzoffset = self.prop.columns[0], self.prop.columns[-1]
+        if self.adapter:
+            column_utc, column_tzoffset = self.adapter(column_utc), self.adapter(column_tzoffset)
+        return function(column_utc, column_tzoffset)
+
+    def local_datetime(self):
+        """SQL expression for the local date and time (see local_datetime)"""
+        return self._local(local_datetime)
+
+    def local_date(self):
+        """SQL expression for the local calendar date, e.g. to GROUP BY local day"""
+        return self._local(local_date)
+
+    def local_hour(self):
+        """SQL expression for the local date and time truncated to the hour"""
+        return self._local(local_hour)
+
+def _composite(composite_class, columns):
+    """composite property of a TZAwareDateTime; ZoneId names are added at flush"""
+    if any(isinstance(c.type, ZoneId) for c in columns):
+        return _ZoneNameCompositeProperty(composite_class, *columns,
+                                          comparator_factory=TZAwareDateTimeComparator)
+    return composite(composite_class, *columns, comparator_factory=TZAwareDateTimeComparator)
+
+def _layout_columns(columnname, storage='datetime', zones=None):
+    """new Column objects, named and keyed <columnname>_<template name>, for a storage layout"""
+    if zones is not None and storage != 'datetime':
+        raise ValueError("zones requires storage='datetime'; %r does not store tzname"
+                         % storage)
+    newcolumns = []
+    for key, name, coltype in _layout_specs(storage)[1]:
+        if zones is not None and key == 'tzname':
+            name, coltype = 'tzid', ZoneId(zones)
+        newcolumns.append(Column('%s_%s' % (columnname, name), coltype,
+                                 key='%s_%s' % (columnname, key)))
+    return newcolumns
 
 class helper(object):
     """functions to insert TZAwareDateTime into database objects"""
 
     @staticmethod
-    def append_columns(newtable, columnname):
+    def append_columns(newtable, columnname, index=False, composite_indexes=(), covering=False,
+                       storage='datetime', zones=None):
         """given a sqlalchemy Table, add the TZAwareDatetime Column objects to it
-        Modifies newtable in place"""
-        # set prefixes for these columns
-        for c in TZAwareDateTimeColumns:
-            # NOTE: a copy must be made first, then attributes set;
-            #   setting name & key args in column.copy() does not work
-            newcolumn = c.copy()
-            #assert isinstance(newcolumn, Column)
-            newcolumn.name = '%s_%s' % (columnname, c.name)
-            newcolumn.key = '%s_%s' % (columnname, c.key)
+        Modifies newtable in place
+
+        storage: 'datetime' adds <columnname>_utcdate, _tzname and _tzoffset;
+          'epoch' adds <columnname>_utcmicros (integer microseconds since 1970,
+          UTC) and _tzoffset, and does not store the timezone name
+        zones: a ZoneNameRegistry; the timezone name is then stored as a small
+          integer id in a <columnname>_tzid column (still keyed <columnname>_tzname,
+          so get_mapper_definition, bulk and stream work unchanged)
+        index: also create an index on the <columnname>_utcdate column
+        composite_indexes: sequence of column-key sequences; one index is created
+          for each, on those columns followed by <columnname>_utcdate,
+          e.g. [('tenant_id',)] indexes (tenant_id, <columnname>_utcdate)
+        covering: append <columnname>_tzoffset to every index created above, so
+          queries reading only the UTC date and offset never touch the table;
+          requires index or composite_indexes (ValueError otherwise)
+        (with epoch storage the indexes use <columnname>_utcmicros instead)
+        """
+        if covering and not (index or composite_indexes):
+            raise ValueError('covering requires index=True or composite_indexes')
+        # look up the leading columns first: a missing key (KeyError) leaves newtable unchanged
+        leading_columns = [[newtable.c[key] for key in leading_keys]
+                           for leading_keys in composite_indexes]
+        newcolumns = _layout_columns(columnname, storage, zones)
+        for newcolumn in newcolumns:
             newtable.append_column(newcolumn)
+
+        column_utcdate, column_tzoffset = newcolumns[0], newcolumns[-1]
+        index_columns = []
+        if index:
+            index_columns.append([column_utcdate])
+        for columns in leading_columns:
+            index_columns.append(columns + [column_utcdate])
+        for columns in index_columns:
+            if covering:
+                columns.append(column_tzoffset)
+            Index('ix_%s_%s' % (newtable.name, '_'.join(c.name for c in columns)), *columns)
             
     @staticmethod
-    def get_mapper_definition(newtable, columnname):
-        """Given a Table object, return the Mapper definition for a TZAwareDateTime column"""
-        # cycle through columns, find the utcdate, tzname, tzoffset columns
-        column_utcdate, column_tzname, column_tzoffset = None, None, None
-        new_column_names = {'utcdate': '%s_%s' % (columnname, TZAwareDateTimeColumnNames[0]),
-                            'tzname': '%s_%s' % (columnname, TZAwareDateTimeColumnNames[1]),
-                            'tzoffset': '%s_%s' % (columnname, TZAwareDateTimeColumnNames[2])
-                            }
-
-        for c in newtable.c:
-            assert isinstance(c, Column)
-            if c.key == new_column_names['utcdate']:
-                column_utcdate = c
-            elif c.key == new_column_names['tzname']:
-                column_tzname = c
-            elif c.key == new_column_names['tzoffset']:
-                column_tzoffset = c
-            if column_utcdate != column_tzname != column_tzoffset != None:
+    def get_mapper_definition(newtable, columnname, storage='datetime', composite_class=None):
+        """Given a Table object, return the Mapper definition for a TZAwareDateTime column
+
+        Comparisons and ordering on the returned composite use the UTC column only
+        (see TZAwareDateTimeComparator). storage must match helper.append_columns;
+        'epoch' composites hold EpochTZAwareDateTime values.
+        composite_class: value class to use instead of the storage default, e.g.
+          NamedZoneTZAwareDateTime for 'datetime' storage"""
+        layout_class, specs = _layout_specs(storage)
+        return _composite(composite_class or layout_class,
+                          [newtable.c['%s_%s' % (columnname, key)] for key, name, coltype in specs])
+
+    @staticmethod
+    def declare(columnname, storage='datetime', composite_class=None, index=False, zones=None):
+        """return a composite with its own new columns, for declarative classes
+
+        Builds the columns of helper.append_columns and the composite of
+        helper.get_mapper_definition in one step, without a Table:
+          class Event(Base):
+              __tablename__ = 'event'
+              id = Column(Integer, primary_key=True)
+              created = helper.declare('created', index=True)
+        In a mixin, return it from a declared_attr function. index creates the
+        same ix_<table>_<columnname>_utcdate index as append_columns; other
+        indexes go in __table_args__.
+        """
+        newcolumns = _layout_columns(columnname, storage, zones)
+        newcolumns[0].index = index
+        return _composite(composite_class or _layout_specs(storage)[0], newcolumns)
+
+    @staticmethod
+    def prewarm_zones(connectable, table, columnname):
+        """resolve every distinct timezone name stored under columnname into tzinfo_registry
+
+        Call at startup for NamedZoneTZAwareDateTime columns; returns the names that resolved."""
+        column_tzname = table.c['%s_%s' % (columnname, TZAwareDateTimeColumnNames[1])]
+        names = [row[0] for row in connectable.execute(
+            select([column_tzname], column_tzname != None).distinct())]
+        return tzinfo_registry.prewarm(names)
+
+    @staticmethod
+    def migrate_storage(connectable, source_table, target_table, columnname, columns=(),
+                        source_storage='datetime', target_storage='epoch', chunksize=1000):
+        """copy rows between tables using different storage layouts for columnname
+
+        columns: keys of other columns copied as-is (e.g. the primary key);
+          they must exist under the same key in both tables
+        Going from 'datetime' to 'epoch' drops the timezone name. Pass a
+        Connection inside a transaction: rows are read and written together.
+        Returns the number of rows copied."""
+        source_class, source_template = _storage_layout(source_storage)
+        target_template = _storage_layout(target_storage)[1]
+        source_columns = [source_table.c['%s_%s' % (columnname, c.key)] for c in source_template]
+        target_keys = ['%s_%s' % (columnname, c.key) for c in target_template]
+        size = len(source_columns)
+        statement = select(source_columns + [source_table.c[key] for key in columns])
+
+        def params():
+            result = connectable.execute(statement.execution_options(stream_results=True))
+            try:
+                while True:
+                    rows = result.fetchmany(chunksize)
+                    if not rows:
+                        break
+                    for row in rows:
+                        row = tuple(row)
+                        value = source_class(*row[:size])
+                        # template column key: value
+                        values = {'utcdate': value.utcdt,
+                                  'utcmicros': value.utcdt,
+                                  'tzname': value.tzname,
+                                  'tzoffset': value.offsetseconds}
+                        newrow = dict(zip(columns, row[size:]))
+                        for key, c in zip(target_keys, target_template):
+                            newrow[key] = values[c.key]
+                        yield newrow
+            finally:
+                result.close()
+        return bulk._execute_chunks(connectable, target_table.insert(), params(), chunksize)
+
+class bulk(object):
+    """Core insert/update of TZAwareDateTime columns without per-object ORM work"""
+
+    @staticmethod
+    def composite_values(realdates):
+        """yield (utcdt, tzname, offsetseconds) for each timezone-aware datetime (None allowed)"""
+        split = _composite_values_from_realdate
+        for realdate in realdates:
+            if realdate is None:
+                yield (None, None, None)
+            else:
+                yield split(realdate)
+
+    @staticmethod
+    def _rows(columnname, rows, storage='datetime'):
+        """yield parameter dicts; rows are aware datetimes or dicts holding one under columnname"""
+        split = _composite_values_from_realdate
+        keys, pick = _triple_layout(columnname, storage)
+        empty = dict.fromkeys(keys)
+        for row in rows:
+            if isinstance(row, dict):
+                params = dict(row)
+                realdate = params.pop(columnname)
+            else:
+                params = {}
+                realdate = row
+            if realdate is None:
+                params.update(empty)
+            else:
+                params.update(zip(keys, pick(split(realdate))))
+            yield params
+
+    @staticmethod
+    def _execute(connectable, statement, chunk):
+        """executemany statement over chunk, first adding new timezone names on connectable"""
+        for key, registry in _zone_columns(statement.table):
+            registry.register(connectable, [params.get(key) for params in chunk])
+        connectable.execute(statement, chunk)
+
+    @staticmethod
+    def _execute_chunks(connectable, statement, params, chunksize):
+        """executemany statement over params, chunksize rows at a time; return the row count"""
+        count = 0
+        while True:
+            chunk = list(islice(params, chunksize))
+            if not chunk:
+                return count
+            bulk._execute(connectable, statement, chunk)
+            count += len(chunk)
+
+    @staticmethod
+    def insert(connectable, table, columnname, rows, chunksize=1000):
+        """insert rows into a table built with helper.append_columns(table, columnname)
+
+        rows: timezone-aware datetimes, or dicts of column values holding the
+          aware datetime under the columnname key
+        connectable: Engine or Connection; wrap the call in a transaction to
+          make the whole load atomic
+        Returns the number of rows inserted."""
+        return bulk._execute_chunks(connectable, table.insert(),
+                                    bulk._rows(columnname, rows, _table_storage(table, columnname)),
+                                    chunksize)
+
+    @staticmethod
+    def update(connectable, table, columnname, rows, key_columns=None, chunksize=1000):
+        """set the TZAwareDateTime columns of existing rows
+
+        rows: dicts holding the aware datetime under the columnname key plus
+          the key column values that identify each row (other values are updated too)
+        key_columns: column keys matched in the WHERE clause; defaults to the primary key
+        Returns the number of parameter sets executed."""
+        if key_columns is None:
+            key_columns = [c.key for c in table.primary_key]
+        storage = _table_storage(table, columnname)
+        statement = table.update()
+        for key in key_columns:
+            statement = statement.where(table.c[key] == bindparam('_key_%s' % key))
+        def params():
+            for row in bulk._rows(columnname, rows, storage):
+                for key in key_columns:
+                    row['_key_%s' % key] = row.pop(key)
+                yield row
+        return bulk._execute_chunks(connectable, statement, params(), chunksize)
+
+class stream(object):
+    """generators that read TZAwareDateTime columns in bounded memory"""
+
+    @staticmethod
+    def select(connectable, table, columnname, columns=(), whereclause=None, order_by=None,
+               chunksize=1000, realdate=False, composite_class=None):
+        """yield the TZAwareDateTime stored under columnname for each selected row
+
+        columns: extra Column objects or column keys; when given, each item is
+          a tuple of (value, extra values...)
+        whereclause, order_by: passed to the SELECT
+        chunksize: rows fetched per round trip; the result is read with
+          stream_results (server-side cursors where the dialect supports them),
+          so memory use depends on chunksize, not on the number of rows
+        realdate: yield aware datetimes (the .realdate) instead of composite_class values
+        composite_class: defaults to the class of the table's storage layout
+        """
+        layout_class, specs = _layout_specs(_table_storage(table, columnname))
+        composite_class = composite_class or layout_class
+        size = len(specs)
+        extras = [table.c[c] if isinstance(c, basestring) else c for c in columns]
+        statement = select([table.c['%s_%s' % (columnname, key)] for key, name, coltype in specs]
+                           + extras, whereclause).execution_options(stream_results=True)
+        if order_by is not None:
+            statement = statement.order_by(order_by)
+
+        result = connectable.execute(statement)
+        try:
+            while True:
+                rows = result.fetchmany(chunksize)
+                if not rows:
+                    break
+                for row in rows:
+                    row = tuple(row)
+                    value = composite_class(*row[:size])
+                    if realdate:
+                        value = value.realdate
+                    if extras:
+                        yield (value,) + row[size:]
+                    else:
+                        yield value
+        finally:
+            result.close()
+
+class TimePartitionedTable(object):
+    """Per-period tables (e.g. events_201001, events_201002) holding one TZAwareDateTime column
+
+    Every partition has the same columns plus those added by
+    helper.append_columns; rows go to the partition of their UTC instant, and
+    range reads only touch the partitions overlapping the range. Ranges are
+    half-open, [start, end), with aware datetimes or TZAwareDateTime values
+    as bounds (None leaves that side open).
+
+    Partitions become known through create(), insert() or load(); a new
+    process should load() the ones already in the database.
+    """
+    _PERIODS = ('month', 'day')
+
+    def __init__(self, metadata, basename, columnname, columns=(), period='month',
+                 **append_kwargs):
+        """metadata: MetaData the partition tables are defined in
+        columns: Column objects copied into every partition, e.g. a primary key
+        period: 'month' or 'day'
+        append_kwargs: passed to helper.append_columns (index, composite_indexes, ...)
+        """
+        if period not in self._PERIODS:
+            raise ValueError('unknown partition period %r (expected one of %s)'
+                             % (period, ', '.join(self._PERIODS)))
+        self.metadata = metadata
+        self.basename = basename
+        self.columnname = columnname
+        self.columns = tuple(columns)
+        self.period = period
+        self.append_kwargs = append_kwargs
+        self.storage = append_kwargs.get('storage', 'datetime')
+        # <columnname>_utcdate, or _utcmicros for epoch storage
+        self._utc_key = '%s_%s' % (columnname, _layout_specs(self.storage)[1][0][0])
+        self._partitions = {}
+        self._created = set()
+        self._lock = threading.Lock()
+        self._name_pattern = re.compile(r'%s_(\d{4})(\d\d)%s$'
+                                        % (re.escape(basename),
+                                           r'(\d\d)' if period == 'day' else ''))
+
+    def period_start(self, value):
+        """naive UTC start of the period holding value (aware datetime or TZAwareDateTime)"""
+        return self._period_key(_utc_operand(value))
+
+    def _period_key(self, utcdt):
+        if self.period == 'day':
+            return datetime(utcdt.year, utcdt.month, utcdt.day)
+        return datetime(utcdt.year, utcdt.month, 1)
+
+    def _period_end(self, start):
+        if self.period == 'day':
+            return start + timedelta(days=1)
+        if start.month == 12:
+            return datetime(start.year + 1, 1, 1)
+        return datetime(start.year, start.month + 1, 1)
+
+    def _tablename(self, start):
+        # not strftime: it rejects years before 1900
+        if self.period == 'day':
+            return '%s_%04d%02d%02d' % (self.basename, start.year, start.month, start.day)
+        return '%s_%04d%02d' % (self.basename, start.year, start.month)
+
+    def table(self, start):
+        """Table for the period starting at start (defined in metadata, not created)"""
+        try:
+            return self._partitions[start]
+        except KeyError:
+            pass
+        with self._lock:
+            if start not in self._partitions:
+                newtable = Table(self._tablename(start), self.metadata,
+                                 *[c.copy() for c in self.columns])
+                helper.append_columns(newtable, self.columnname, **self.append_kwargs)
+                self._partitions[start] = newtable
+            return self._partitions[start]
+
+    def _create(self, connectable, start):
+        newtable = self.table(start)
+        if start not in self._created:
+            newtable.create(bind=connectable, checkfirst=True)
+            self._created.add(start)
+        return newtable
+
+    def load(self, connectable):
+        """find the partitions already in the database; return their period starts"""
+        found = []
+        for name in Inspector.from_engine(connectable).get_table_names():
+            match = self._name_pattern.match(name)
+            if match is not None:
+                # monthly names have no day
+                start = datetime(*([int(part) for part in match.groups()] + [1])[:3])
+                self.table(start)
+                self._created.add(start)
+                found.append(start)
+        return sorted(found)
+
+    def create(self, connectable, start, end):
+        """create (if missing) every partition overlapping [start, end); return the tables"""
+        return [self._create(connectable, key)
+                for key in self._period_starts(_utc_operand(start), _utc_operand(end))]
+
+    def _period_starts(self, start, end):
+        key = self._period_key(start)
+        while key < end:
+            yield key
+            key = self._period_end(key)
+
+    def partitions(self, start=None, end=None):
+        """known (period start, Table) pairs overlapping [start, end), in UTC order"""
+        return self._overlapping(_utc_operand(start), _utc_operand(end))
+
+    def _overlapping(self, start, end):
+        return [(key, self._partitions[key]) for key in sorted(self._partitions)
+                if (end is None or key < end) and (start is None or self._period_end(key) > start)]
+
+    def _range_clause(self, partition, start, end):
+        column_utcdate = partition.c[self._utc_key]
+        clauses = []
+        if start is not None:
+            clauses.append(column_utcdate >= start)
+        if end is not None:
+            clauses.append(column_utcdate < end)
+        return and_(*clauses) if clauses else None
+
+    def insert(self, connectable, rows, chunksize=1000):
+        """insert rows, each into the partition of its UTC instant (created when missing)
+
+        rows are as for bulk.insert; returns the number of rows inserted"""
+        pending = {}
+        count = 0
+        for params in bulk._rows(self.columnname, rows, self.storage):
+            if params[self._utc_key] is None:
+                raise ValueError('cannot route a row without a %s value' % self.columnname)
+            key = self.period_start(params[self._utc_key])
+            chunk = pending.setdefault(key, [])
+            chunk.append(params)
+            if len(chunk) >= chunksize:
+                bulk._execute(connectable, self._create(connectable, key).insert(), chunk)
+                count += len(chunk)
+                del pending[key]
+        for key, chunk in sorted(pending.items()):
+            bulk._execute(connectable, self._create(connectable, key).insert(), chunk)
+            count += len(chunk)
+        return count
+
+    def select(self, start=None, end=None, columns=None):
+        """UNION ALL of SELECTs over the partitions overlapping [start, end), or None if there
+        are none; columns are column keys (default: all). Add
+        .order_by('<columnname>_utcdate') (_utcmicros with epoch storage) for UTC order."""
+        start, end = _utc_operand(start), _utc_operand(end)
+        selects = []
+        for key, partition in self._overlapping(start, end):
+            selected = [partition.c[c] for c in columns] if columns else [partition]
+            selects.append(select(selected, self._range_clause(partition, start, end)))
+        if not selects:
+            return None
+        if len(selects) == 1:
+            return selects[0]
+        return union_all(*selects)
+
+    def stream(self, connectable, start=None, end=None, columns=(), chunksize=1000,
+               realdate=False, composite_class=None):
+        """yield values in [start, end) in UTC order across partitions (see stream.select)
+
+        Partitions cover disjoint periods, so reading them one after another,
+        each ordered by UTC, is a merge in UTC order with one cursor open."""
+        start, end = _utc_operand(start), _utc_operand(end)
+        for key, partition in self._overlapping(start, end):
+            for item in stream.select(connectable, partition, self.columnname, columns,
+                                      self._range_clause(partition, start, end),
+                                      partition.c[self._utc_key], chunksize, realdate,
+                                      composite_class):
+                yield item
+
+# YYYY-MM-DD[T ]HH:MM:SS[.ffffff](Z|+HH:MM|+HHMM)
+_ISO8601_FIXED = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)'
+                            r'(?:[.,](\d{1,6})\d*)?\s*(?:(Z)|([+-])(\d\d):?(\d\d))$')
+
+def _parse_timestamp(timestamp):
+    """(naive UTC datetime, tzname, offsetseconds) for one ISO-8601 string with an offset"""
+    timestamp = timestamp.strip()
+    match = _ISO8601_FIXED.match(timestamp)
+    if match is None:
+        # anything else dateutil understands
+        realdate = dateutil_parser.parse(timestamp)
+        if realdate.tzinfo is None or realdate.utcoffset() is None:
+            raise ValueError('timestamp has no UTC offset: %r' % timestamp)
+        utcdt, tzname, offsetseconds = _composite_values_from_realdate(realdate)
+        return utcdt.replace(tzinfo=None), tzname, offsetseconds
+
+    (year, month, day, hour, minute, second, fraction,
+     zulu, sign, offset_hours, offset_minutes) = match.groups()
+    localdt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                       int(fraction.ljust(6, '0')) if fraction else 0)
+    if zulu:
+        return localdt, u'UTC', 0
+    # stored offset is seconds between local date and UTC
+    offsetseconds = int(offset_hours) * 3600 + int(offset_minutes) * 60
+    if not offsetseconds:
+        # +00:00, -00:00 and +0000 are named UTC, as by dateutil's parser
+        return localdt, u'UTC', 0
+    if sign == '+':
+        offsetseconds = -offsetseconds
+    return localdt + timedelta(seconds=offsetseconds), None, offsetseconds
+
+def _parse_timestamp_chunk(timestamps):
+    """parse a list of timestamps (module level so worker processes can unpickle it)"""
+    return [_parse_timestamp(timestamp) for timestamp in timestamps]
+
+class ingest(object):
+    """parse ISO-8601 timestamp streams into TZAwareDateTime storage triples"""
+
+    @staticmethod
+    def parse(timestamp):
+        """return (utcdate, tzname, offsetseconds) for one timestamp string
+
+        utcdate is a naive UTC datetime, as stored in the utcdate column.
+        YYYY-MM-DD[T ]HH:MM:SS[.ffffff] followed by Z, +HH:MM or +HHMM is
+        parsed directly; other formats go through dateutil's parser. A
+        timestamp without a UTC offset raises ValueError."""
+        return _parse_timestamp(timestamp)
+
+    @staticmethod
+    def triples(timestamps, processes=None, chunksize=10000):
+        """yield (utcdate, tzname, offsetseconds) for each timestamp, in input order
+
+        timestamps: iterable of strings, e.g. an open file (lines are stripped,
+          blank lines skipped)
+        processes: worker processes (default: one per CPU); 1 parses in this process
+        chunksize: timestamps per task; at most two tasks per worker are in
+          flight, so memory stays bounded however long the input is
+        """
+        timestamps = (timestamp for timestamp in timestamps if timestamp.strip())
+        chunks = iter(lambda: list(islice(timestamps, chunksize)), [])
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes <= 1:
+            for chunk in chunks:
+                for triple in _parse_timestamp_chunk(chunk):
+                    yield triple
+            return
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_parse_timestamp_chunk, (chunk,)))
+                if len(pending) >= processes * 2:
+                    for triple in pending.popleft().get():
+                        yield triple
+            while pending:
+                for triple in pending.popleft().get():
+                    yield triple
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def insert(connectable, table, columnname, timestamps, processes=None, chunksize=10000):
+        """parse timestamps and insert one row each into a table built with
+        helper.append_columns(table, columnname); returns the number of rows"""
+        keys, pick = _triple_layout(columnname, _table_storage(table, columnname))
+        params = (dict(zip(keys, pick(triple)))
+                  for triple in ingest.triples(timestamps, processes, chunksize))
+        return bulk._execute_chunks(connectable, table.insert(), params, chunksize)
+
+class packed(object):
+    """compact binary encoding of lists of TZAwareDateTime values, e.g. for caches
+
+    Layout (little-endian): header, the distinct tznames, then one column
+    each of flags, UTC microseconds, offsetseconds and tzname index.
+    The cached .realdate is not stored.
+    """
+    _header = struct.Struct('<4sBII')
+    _magic = 'TZDT'
+    _version = 1
+    # flags
+    _HAS_UTC = 1
+    _AWARE = 2
+    _HAS_OFFSET = 4
+
+    @staticmethod
+    def encode(values):
+        """return a byte string holding the values (any _TZAwareDateTimeBase instances)"""
+        names = {}
+        flags, micros, offsets, nameindexes = [], [], [], []
+        for value in values:
+            flag = 0
+            utcdt = value.utcdt
+            if utcdt is None:
+                micros.append(0)
+            else:
+                flag |= packed._HAS_UTC
+                if utcdt.tzinfo is not None:
+                    flag |= packed._AWARE
+                micros.append(_utc_micros(_utc_key(utcdt)))
+            offsetseconds = value.offsetseconds
+            if offsetseconds is None:
+                offsets.append(0)
+            else:
+                flag |= packed._HAS_OFFSET
+                offsets.append(offsetseconds)
+            flags.append(flag)
+            tzname = value.tzname
+            if tzname is None:
+                nameindexes.append(0)
+            else:
+                # index 0 is reserved for None
+                nameindexes.append(names.setdefault(tzname, len(names) + 1))
+        if len(names) > 0xFFFF:
+            raise ValueError('more than 65535 distinct timezone names')
+
+        count = len(flags)
+        parts = [packed._header.pack(packed._magic, packed._version, count, len(names))]
+        for tzname, index in sorted(names.items(), key=lambda item: item[1]):
+            encoded = unicode(tzname).encode('utf-8')
+            parts.append(struct.pack('<H', len(encoded)))
+            parts.append(encoded)
+        parts.append(struct.pack('<%dB' % count, *flags))
+        parts.append(struct.pack('<%dq' % count, *micros))
+        parts.append(struct.pack('<%di' % count, *offsets))
+        parts.append(struct.pack('<%dH' % count, *nameindexes))
+        return ''.join(parts)
+
+    @staticmethod
+    def decode(buffer, composite_class=TZAwareDateTime):
+        """return the list of composite_class values encoded by packed.encode"""
+        magic, version, count, namecount = packed._header.unpack_from(buffer, 0)
+        if magic != packed._magic or version != packed._version:
+            raise ValueError('not a packed TZAwareDateTime buffer')
+        position = packed._header.size
+        names = [None]
+        for i in xrange(namecount):
+            length, = struct.unpack_from('<H', buffer, position)
+            position += 2
+            names.append(buffer[position:position + length].decode('utf-8'))
+            position += length
+        columns = []
+        for code, size in (('B', 1), ('q', 8), ('i', 4), ('H', 2)):
+            columns.append(struct.unpack_from('<%d%s' % (count, code), buffer, position))
+            position += count * size
+        values = []
+        for flag, utcmicros, offsetseconds, nameindex in zip(*columns):
+            values.append(_restore(composite_class,
+                                   utcmicros if flag & packed._HAS_UTC else None,
+                                   offsetseconds if flag & packed._HAS_OFFSET else None,
+                                   names[nameindex],
+                                   flag & packed._AWARE))
+        return values
+
+class arrays(object):
+    """column-at-a-time conversion between TZAwareDateTime storage columns and arrays
+
+    With numpy installed the results are numpy arrays; otherwise (or with
+    use_numpy=False) plain lists of datetimes and ints are returned.
+    """
+
+    @staticmethod
+    def from_columns(utcdates, offsets, use_numpy=True):
+        """convert utcdate and tzoffset column values to (utc, offsets, local)
+
+        utcdates: naive UTC datetimes as read from the utcdate column (None allowed;
+          the pure-Python path also accepts aware datetimes)
+        offsets: seconds between local date and UTC (None is treated as UTC)
+        Returns datetime64[us] UTC values, int32 offsets and datetime64[us]
+        local wall-clock values (NaT where utcdate is None)."""
+        if use_numpy and numpy is not None:
+            # numpy's own datetime object conversion is several times slower
+            # than building the int64 microseconds here
+            nat = numpy.iinfo(numpy.int64).min
+            utc = numpy.fromiter((nat if d is None else
+                                  (d.toordinal() - _EPOCH_ORDINAL) * 86400000000
+                                  + (d.hour * 3600 + d.minute * 60 + d.second) * 1000000
+                                  + d.microsecond
+                                  for d in utcdates), numpy.int64).view('datetime64[us]')
+            # None becomes nan as float, then 0 (UTC)
+            offsets = numpy.nan_to_num(numpy.array(offsets, dtype=numpy.float64)).astype(numpy.int32)
+            return utc, offsets, utc - offsets.astype('timedelta64[s]')
+
+        utc = [_utc_key(d) for d in utcdates]
+        offsets = [o or 0 for o in offsets]
+        local = [None if d is None else d - timedelta(seconds=o)
+                 for d, o in zip(utc, offsets)]
+        return utc, offsets, local
+
+    @staticmethod
+    def to_columns(utc, offsets, tznames=None):
+        """convert UTC values and offsets back to (utcdates, tznames, offsets) column lists
+
+        utc: datetime64 array or naive UTC datetimes; offsets: seconds between
+        local date and UTC. The three lists can be zipped into executemany parameters."""
+        if numpy is not None and isinstance(utc, numpy.ndarray):
+            utcdates = utc.astype('datetime64[us]').tolist()
+        else:
+            utcdates = list(utc)
+        if numpy is not None and isinstance(offsets, numpy.ndarray):
+            offsets = offsets.tolist()
+        else:
+            offsets = list(offsets)
+        if tznames is None:
+            tznames = [None] * len(utcdates)
+        else:
+            tznames = list(tznames)
+        return utcdates, tznames, offsets
+
+# column store file layout (little-endian):
+#   header   '<4sB3x'  magic, version
+#   chunks   int64 UTC microseconds, int32 offsets, int32 tzname indexes; each
+#            column padded to 8 bytes so it can be viewed in place
+#   footer   '<I' chunk count, '<QI' (file position, rows) per chunk,
+#            '<I' tzname count, '<H' length + utf-8 bytes per tzname
+#   trailer  '<Q4s'  footer position, magic
+_COLUMNSTORE_MAGIC = 'TZCS'
+_COLUMNSTORE_VERSION = 1
+_COLUMNSTORE_HEADER = struct.Struct('<4sB3x')
+_COLUMNSTORE_TRAILER = struct.Struct('<Q4s')
+_COLUMNSTORE_CHUNK = struct.Struct('<QI')
+# stored for None (the int64 value is numpy's NaT)
+_NULL_MICROS = -2 ** 63
+_NULL_OFFSET = -2 ** 31
+_NULL_NAME = -1
+
+def _padding(size):
+    return '\0' * (-size % 8)
+
+class columnstore(object):
+    """export TZAwareDateTime columns to a chunked, memory-mappable column file
+
+    Each chunk holds contiguous int64 UTC microseconds, int32 offsets and
+    int32 indexes into a dictionary of timezone names; read it back with
+    ColumnStoreFile. None is stored as the minimum value of the column type
+    (-1 for names).
+    """
+
+    @staticmethod
+    def _encode_chunk(rows, names):
+        micros, offsets, nameindexes = [], [], []
+        for utcdt, tzname, offsetseconds in rows:
+            micros.append(_NULL_MICROS if utcdt is None else _utc_micros(_utc_key(utcdt)))
+            offsets.append(_NULL_OFFSET if offsetseconds is None else offsetseconds)
+            if tzname is None:
+                nameindexes.append(_NULL_NAME)
+            else:
+                nameindexes.append(names.setdefault(tzname, len(names)))
+        count = len(micros)
+        parts = [struct.pack('<%dq' % count, *micros),
+                 struct.pack('<%di' % count, *offsets), _padding(4 * count),
+                 struct.pack('<%di' % count, *nameindexes), _padding(4 * count)]
+        return ''.join(parts)
+
+    @staticmethod
+    def write(fileobj, triples, chunksize=65536):
+        """write (utcdt, tzname, offsetseconds) triples to an open binary file; return the row count
+
+        Only chunksize rows are held in memory at a time."""
+        triples = iter(triples)
+        names = {}
+        chunks = []
+        fileobj.write(_COLUMNSTORE_HEADER.pack(_COLUMNSTORE_MAGIC, _COLUMNSTORE_VERSION))
+        position = _COLUMNSTORE_HEADER.size
+        while True:
+            rows = list(islice(triples, chunksize))
+            if not rows:
                 break
+            data = columnstore._encode_chunk(rows, names)
+            fileobj.write(data)
+            chunks.append((position, len(rows)))
+            position += len(data)
+
+        footer = [struct.pack('<I', len(chunks))]
+        footer.extend(_COLUMNSTORE_CHUNK.pack(*chunk) for chunk in chunks)
+        footer.append(struct.pack('<I', len(names)))
+        for tzname, index in sorted(names.items(), key=lambda item: item[1]):
+            encoded = unicode(tzname).encode('utf-8')
+            footer.append(struct.pack('<H', len(encoded)) + encoded)
+        footer.append(_COLUMNSTORE_TRAILER.pack(position, _COLUMNSTORE_MAGIC))
+        fileobj.write(''.join(footer))
+        return sum(rows for position, rows in chunks)
+
+    @staticmethod
+    def export(connectable, table, columnname, path, whereclause=None, order_by=None,
+               chunksize=65536):
+        """stream columnname of the selected rows of table into a column file at path
+
+        The storage layout of the columns is detected from table. Rows are
+        read with stream_results, chunksize at a time, and written as they
+        arrive; returns the number of rows."""
+        keys = [key for key, name, coltype in _layout_specs(_table_storage(table, columnname))[1]]
+        statement = select([table.c['%s_%s' % (columnname, key)] for key in keys],
+                           whereclause).execution_options(stream_results=True)
+        if order_by is not None:
+            statement = statement.order_by(order_by)
+        def triples(result):
+            try:
+                while True:
+                    rows = result.fetchmany(chunksize)
+                    if not rows:
+                        break
+                    for row in rows:
+                        if len(keys) == 2:
+                            # epoch storage has no tzname
+                            yield row[0], None, row[1]
+                        else:
+                            yield row[0], row[1], row[2]
+            finally:
+                result.close()
+        with open(path, 'wb') as fileobj:
+            return columnstore.write(fileobj, triples(connectable.execute(statement)), chunksize)
+
+class ColumnStoreFile(object):
+    """Read-only, memory-mapped view of a file written by columnstore
+
+    With numpy installed, chunk columns are numpy arrays over the mapped file
+    (no copy); otherwise they are tuples.
+    """
+    def __init__(self, path, use_numpy=True):
+        self.use_numpy = use_numpy and numpy is not None
+        with open(path, 'rb') as fileobj:
+            self._map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_footer(path)
+        except Exception:
+            self.close()
+            raise
+        self.rows = sum(rows for start, rows in self._chunks)
+        self.chunkcount = len(self._chunks)
+
+    def _read_footer(self, path):
+        """load the chunk table and tzname dictionary, checking every position (ValueError)"""
+        def malformed(reason):
+            return ValueError('%s is not a TZAwareDateTime column store file (%s)'
+                              % (path, reason))
+        trailer_position = len(self._map) - _COLUMNSTORE_TRAILER.size
+        if trailer_position < _COLUMNSTORE_HEADER.size:
+            raise malformed('too short')
+        magic, version = _COLUMNSTORE_HEADER.unpack_from(self._map, 0)
+        footer, trailer_magic = _COLUMNSTORE_TRAILER.unpack_from(self._map, trailer_position)
+        if (magic != _COLUMNSTORE_MAGIC or trailer_magic != _COLUMNSTORE_MAGIC
+                or version != _COLUMNSTORE_VERSION):
+            raise malformed('bad magic or version')
+        if not _COLUMNSTORE_HEADER.size <= footer <= trailer_position:
+            raise malformed('footer position out of range')
+
+        def unpack(fmt, position):
+            size = struct.calcsize(fmt)
+            if position + size > trailer_position:
+                raise malformed('footer truncated')
+            return struct.unpack_from(fmt, self._map, position), position + size
+
+        (chunkcount,), position = unpack('<I', footer)
+        self._chunks = []
+        end = _COLUMNSTORE_HEADER.size
+        for i in xrange(chunkcount):
+            chunk, position = unpack(_COLUMNSTORE_CHUNK.format, position)
+            start, rows = chunk
+            if start != end:
+                raise malformed('chunk %d position out of range' % i)
+            end = start + 8 * rows + 2 * (4 * rows + len(_padding(4 * rows)))
+            if end > footer:
+                raise malformed('chunk %d overruns the footer' % i)
+            self._chunks.append(chunk)
+        (namecount,), position = unpack('<I', position)
+        self.names = []
+        for i in xrange(namecount):
+            (length,), position = unpack('<H', position)
+            if position + length > trailer_position:
+                raise malformed('footer truncated')
+            self.names.append(self._map[position:position + length].decode('utf-8'))
+            position += length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """release the file; it stays mapped while arrays returned by chunk() are referenced"""
+        # mmap.close() would free memory those numpy views still point into
+        self._map = None
+
+    # column item size: numpy dtype, struct format code
+    _COLUMN_TYPES = {8: ('<i8', 'q'), 4: ('<i4', 'i')}
+
+    def _column(self, itemsize, count, position):
+        dtype, code = self._COLUMN_TYPES[itemsize]
+        if self.use_numpy:
+            return numpy.frombuffer(self._map, dtype=dtype, count=count, offset=position)
+        return struct.unpack_from('<%d%s' % (count, code), self._map, position)
+
+    def chunk(self, index):
+        """(utcmicros, offsets, tzname indexes) of one chunk; None is stored as described
+        in columnstore, and indexes refer to .names"""
+        if self._map is None:
+            raise ValueError('column store file is closed')
+        position, count = self._chunks[index]
+        offsets_position = position + 8 * count
+        names_position = offsets_position + 4 * count + len(_padding(4 * count))
+        return (self._column(8, count, position), self._column(4, count, offsets_position),
+                self._column(4, count, names_position))
+
+    def chunks(self):
+        """yield chunk(index) for every chunk, in file order"""
+        for index in xrange(self.chunkcount):
+            yield self.chunk(index)
+
+    def triples(self):
+        """yield (naive UTC datetime, tzname, offsetseconds) for every row, as stored"""
+        names = self.names
+        for micros, offsets, nameindexes in self.chunks():
+            if self.use_numpy:
+                micros, offsets, nameindexes = micros.tolist(), offsets.tolist(), nameindexes.tolist()
+            for utcmicros, offsetseconds, nameindex in zip(micros, offsets, nameindexes):
+                yield (None if utcmicros == _NULL_MICROS else _from_utc_micros(utcmicros),
+                       None if nameindex == _NULL_NAME else names[nameindex],
+                       None if offsetseconds == _NULL_OFFSET else offsetseconds)
+
+class Instrumentation(object):
+    """Opt-in call counts and timings for the conversion hot paths
+
+    Events: set_realdate (aware datetime -> columns), get_realdate (columns
+    -> aware datetime, cache misses only), construct (new TZAwareDateTime
+    values, including any set_realdate), tzinfo_create (new tzinfo objects)
+    and the helper.append_columns / get_mapper_definition / declare calls.
+
+    Disabled (the default), nothing is wrapped and the hot paths run
+    untouched; enable() swaps in timed wrappers and disable() restores the
+    original functions.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.callback = None
+        self._originals = []
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _targets(self):
+        """(owner, attribute name, event name) for every instrumented function"""
+        return [(sys.modules[__name__], '_composite_values_from_realdate', 'set_realdate'),
+                (_TZAwareDateTimeBase, '_build_realdate', 'get_realdate'),
+                (NamedZoneTZAwareDateTime, '_build_realdate', 'get_realdate'),
+                (_TZAwareDateTimeBase, '__init__', 'construct'),
+                (FrozenTZAwareDateTime, '__init__', 'construct'),
+                (TZInfoRegistry, '_create', 'tzinfo_create'),
+                (helper, 'append_columns', 'helper.append_columns'),
+                (helper, 'get_mapper_definition', 'helper.get_mapper_definition'),
+                (helper, 'declare', 'helper.declare')]
+
+    def enable(self, callback=None):
+        """start counting; callback(event, seconds) is called after every instrumented call"""
+        self.callback = callback
+        if self.enabled:
+            return
+        for owner, attrname, event in self._targets():
+            original = vars(owner)[attrname]
+            self._originals.append((owner, attrname, original))
+            setattr(owner, attrname, self._wrap(original, event))
+        self.enabled = True
+
+    def disable(self):
+        """restore the uninstrumented functions; collected stats are kept"""
+        while self._originals:
+            owner, attrname, original = self._originals.pop()
+            setattr(owner, attrname, original)
+        self.enabled = False
+        self.callback = None
+
+    def _wrap(self, original, event):
+        if isinstance(original, staticmethod):
+            return staticmethod(self._wrap(original.__func__, event))
+        record = self._record
+        def wrapper(*args, **kwargs):
+            start = default_timer()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                record(event, default_timer() - start)
+        wrapper.__name__ = original.__name__
+        wrapper.__doc__ = original.__doc__
+        return wrapper
+
+    def _record(self, event, seconds):
+        with self._lock:
+            stat = self._stats.get(event)
+            if stat is None:
+                stat = self._stats[event] = {'count': 0, 'seconds': 0.0}
+            stat['count'] += 1
+            stat['seconds'] += seconds
+        callback = self.callback
+        if callback is not None:
+            callback(event, seconds)
+
+    def stats(self):
+        """return {event: {'count': calls, 'seconds': total time}}"""
+        with self._lock:
+            return dict((event, dict(stat)) for event, stat in self._stats.items())
 
-        return composite(TZAwareDateTime,
-                         column_utcdate,
-                         column_tzname,
-                         column_tzoffset)
+    def reset(self):
+        """clear collected stats"""
+        with self._lock:
+            self._stats.clear()
 
+# process-wide instrumentation switch
+instrumentation = Instrumentation()